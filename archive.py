@@ -0,0 +1,108 @@
+"""Reading tweets out of a Twitter archive export (the zip file Twitter
+sends you when you download your data).
+
+The tweets are in data/tweets.js (data/tweet.js in older exports, possibly
+split into -partN files) as a JavaScript assignment of one huge JSON array,
+and their media in data/tweets_media/ as <tweet id>-<file name>.  We stream
+the array out of the zip one tweet at a time, keeping only compact Tweet
+records, and upload media straight from the zip."""
+import mimetypes
+import posixpath
+import re
+import zipfile
+
+import tweets
+
+TWEETS_JS = re.compile(r'^data/tweets?(-part\d+)?\.js$')
+ACCOUNT_JS = 'data/account.js'
+MEDIA_DIRS = ('data/tweets_media/', 'data/tweet_media/')
+
+def iter_js_array(fp):
+    """Yields the elements of the JSON array assigned in a
+       'window.YTD.tweets.part0 = [ ... ]' file, reading as it goes."""
+    def chunks():
+        head = b''
+        while True:
+            chunk = fp.read(tweets.CHUNK_SIZE)
+            if not chunk:
+                raise ValueError('no assignment found in archive file')
+            head += chunk
+            eq = head.find(b'=')
+            if eq >= 0:
+                yield head[eq + 1:]
+                break
+
+        while True:
+            chunk = fp.read(tweets.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    return tweets.iter_json_array(chunks())
+
+class TwitterArchive(object):
+    """An open Twitter archive."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename)
+
+        # tweet id -> the names of its media files in the zip
+        self.media = {}
+        for name in self.zip.namelist():
+            if name.startswith(MEDIA_DIRS):
+                tweet_id = posixpath.basename(name).split('-', 1)[0]
+                if tweet_id.isdigit():
+                    self.media.setdefault(int(tweet_id), []).append(name)
+
+        self.screen_name = self._read_screen_name()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.zip.close()
+
+    def _read_screen_name(self):
+        try:
+            fp = self.zip.open(ACCOUNT_JS)
+        except KeyError:
+            return None
+
+        with fp:
+            for item in iter_js_array(fp):
+                return item.get('account', {}).get('username')
+
+    def tweets(self, since=0):
+        """Yields a Tweet for every tweet in the archive newer than since,
+           in archive order.  Their media_urls are names of files in the
+           zip, for rehost_media."""
+        names = sorted(n for n in self.zip.namelist() if TWEETS_JS.match(n))
+        for name in names:
+            with self.zip.open(name) as fp:
+                for item in iter_js_array(fp):
+                    status = item.get('tweet', item)
+                    tweet_id = int(status['id_str'])
+                    if tweet_id <= since:
+                        continue
+
+                    reply_to = status.get('in_reply_to_status_id_str')
+                    yield tweets.Tweet(id=tweet_id,
+                        text=status.get('full_text') or status.get('text', ''),
+                        created_at=status.get('created_at'),
+                        screen_name=self.screen_name,
+                        media_urls=tuple(sorted(self.media.get(tweet_id, ()))),
+                        in_reply_to_status_id=int(reply_to) if reply_to else None)
+
+    def rehost_media(self, m, name, limits=None):
+        """Uploads a media file from the archive to Mastodon, returning the
+           media object, or None if the instance wouldn't take it."""
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if tweets.media_refused(limits, mimetype, self.zip.getinfo(name).file_size) is not None:
+            return None
+
+        return m.media_post(self.zip.read(name), mime_type=mimetype)
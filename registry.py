@@ -0,0 +1,299 @@
+"""A compact in-memory registry of feeds, for a long-running process that
+looks after many of them.
+
+Each feed's config file is parsed once into a slotted Feed record holding
+just what's needed to decide whether and when to run it; the ConfigParser
+object is thrown away, and a run reads the file afresh.  Mastodon app
+credentials and Twitter tokens are the same for many feeds, so they are
+kept once, in shared records, and the strings feeds have in common are
+interned."""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+import ConfigParser
+
+CONFIG_SUFFIXES = ('.ini', '.cfg', '.conf')
+
+class MastodonApp(object):
+    """An app registration on an instance, shared by the feeds using it."""
+    __slots__ = ('instance', 'client_id', 'client_secret')
+
+    def __init__(self, instance, client_id, client_secret):
+        self.instance = instance
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+class TwitterToken(object):
+    """A Twitter OAuth token, shared by the feeds using it."""
+    __slots__ = ('token', 'secret')
+
+    def __init__(self, token, secret):
+        self.token = token
+        self.secret = secret
+
+class Feed(object):
+    """One feed: what it reads ('user', 'list' or 'rss'), the credentials
+       it runs with, and when it may next post."""
+    __slots__ = ('path', 'mtime', 'kind', 'app', 'user_secret', 'twitter',
+                 'next_post_at')
+
+    def __init__(self, path, mtime, kind, app, user_secret, twitter, next_post_at):
+        self.path = path
+        self.mtime = mtime
+        self.kind = kind
+        self.app = app
+        self.user_secret = user_secret
+        self.twitter = twitter
+        self.next_post_at = next_post_at
+
+    def __repr__(self):
+        return '<Feed %s %s>' % (self.path, self.kind)
+
+    @property
+    def runnable(self):
+        """Can the feed run unattended?  It has to be logged in to Mastodon,
+           and to Twitter unless it reads RSS."""
+        return (self.app is not None and self.user_secret is not None
+                and (self.kind == 'rss' or self.twitter is not None))
+
+def _get(config, section, option, default=None):
+    if not config.has_section(section) or not config.has_option(section, option):
+        return default
+    return config.get(section, option)
+
+class FeedRegistry(object):
+    """The feeds we know about, by config file path."""
+
+    def __init__(self):
+        self.feeds = {}
+        self._shared = {}
+        # mtimes of the files we've looked at that aren't (working) feeds
+        self._skipped = {}
+
+    def __len__(self):
+        return len(self.feeds)
+
+    def __iter__(self):
+        return iter(self.feeds.values())
+
+    def __contains__(self, path):
+        return path in self.feeds
+
+    def get(self, path):
+        return self.feeds.get(path)
+
+    def _share(self, cls, *fields):
+        """One shared cls record per distinct set of fields."""
+        if any(f is None for f in fields):
+            return None
+
+        key = (cls,) + fields
+        record = self._shared.get(key)
+        if record is None:
+            record = self._shared[key] = cls(*[intern(f) for f in fields])
+        return record
+
+    def parse(self, path):
+        """Parse a feed's config file into a Feed, without adding it.
+           Returns None if it isn't a complete feed config."""
+        config = ConfigParser.RawConfigParser()
+        if not config.read(path):
+            return None
+
+        if config.has_option('rss', 'url'):
+            kind = 'rss'
+        elif config.has_option('twitter', 'twitter_screen_name'):
+            kind = 'user'
+        elif (config.has_option('twitter', 'twitter_list_owner')
+              and config.has_option('twitter', 'twitter_list_name')):
+            kind = 'list'
+        else:
+            return None
+
+        return Feed(path=intern(path),
+            mtime=os.path.getmtime(path),
+            kind=intern(kind),
+            app=self._share(MastodonApp,
+                _get(config, 'mastodon', 'mastodon_instance'),
+                _get(config, 'mastodon', 'mastodon_client_id'),
+                _get(config, 'mastodon', 'mastodon_client_secret')),
+            user_secret=_get(config, 'mastodon', 'mastodon_user_secret'),
+            twitter=self._share(TwitterToken,
+                _get(config, 'twitter', 'twitter_oauth_token'),
+                _get(config, 'twitter', 'twitter_oauth_secret')),
+            next_post_at=float(_get(config, 'history', 'next_post_at', 0)))
+
+    def load(self, path):
+        """(Re)load one feed's config file.  Returns the Feed, or None if
+           the file isn't a feed config, or is broken (and so isn't
+           registered)."""
+        try:
+            feed = self.parse(path)
+        except (ConfigParser.Error, ValueError, EnvironmentError) as e:
+            sys.stderr.write('Skipping feed %s: %s\n' % (path, e))
+            feed = None
+
+        if feed is None:
+            self.feeds.pop(path, None)
+            try:
+                self._skipped[path] = os.path.getmtime(path)
+            except EnvironmentError:
+                self._skipped.pop(path, None)
+        else:
+            self.feeds[feed.path] = feed
+            self._skipped.pop(path, None)
+        return feed
+
+    def remove(self, path):
+        """Forget a feed.  Returns the Feed, if we had it."""
+        self._skipped.pop(path, None)
+        return self.feeds.pop(path, None)
+
+    def load_directory(self, dirname):
+        """Load every feed config file in dirname."""
+        for name in sorted(os.listdir(dirname)):
+            if name.endswith(CONFIG_SUFFIXES):
+                self.load(os.path.join(dirname, name))
+
+    def apply(self, paths):
+        """Bring the registry up to date with changes to the given config
+           files: load new and changed ones, and drop deleted ones.  Other
+           feeds are left alone.  Returns lists of the paths added, updated
+           and removed."""
+        added, updated, removed = [], [], []
+        for path in paths:
+            if not path.endswith(CONFIG_SUFFIXES):
+                continue
+
+            had = path in self.feeds
+            if not os.path.exists(path):
+                self.remove(path)
+                if had:
+                    removed.append(path)
+            elif self.load(path) is not None:
+                (updated if had else added).append(path)
+            elif had:
+                removed.append(path)
+
+        return added, updated, removed
+
+    def changed_paths(self, dirname):
+        """The config files in dirname that are new, deleted or modified
+           since we loaded them, going by their mtimes."""
+        changed = set()
+        seen = set()
+        for name in os.listdir(dirname):
+            if name.endswith(CONFIG_SUFFIXES):
+                path = os.path.join(dirname, name)
+                seen.add(path)
+                feed = self.feeds.get(path)
+                mtime = feed.mtime if feed is not None else self._skipped.get(path)
+                if mtime != os.path.getmtime(path):
+                    changed.add(path)
+
+        for path in list(self.feeds) + list(self._skipped):
+            if os.path.dirname(path) == dirname and path not in seen:
+                changed.add(path)
+
+        return changed
+
+    def due(self, now):
+        """The feeds whose scheduler would let them post by now."""
+        return [feed for feed in self.feeds.values() if feed.next_post_at <= now]
+
+class PollingWatcher(object):
+    """Watches a directory of feed configs by checking mtimes every time
+       it's asked."""
+
+    def __init__(self, dirname, registry):
+        self.dirname = dirname
+        self.registry = registry
+
+    def close(self):
+        pass
+
+    def changes(self, timeout):
+        """Waits timeout seconds, then returns the config files changed."""
+        time.sleep(timeout)
+        return self.registry.changed_paths(self.dirname)
+
+class InotifyWatcher(object):
+    """Watches a directory of feed configs with Linux's inotify, so only
+       the files that actually changed are looked at."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, dirname, registry):
+        self.dirname = dirname
+        self.registry = registry
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.path.abspath(dirname), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed on %s' % dirname)
+
+    def close(self):
+        os.close(self.fd)
+
+    def changes(self, timeout):
+        """Waits up to timeout seconds for changes, and returns the config
+           files changed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        # let a burst of writes settle, then take everything queued
+        time.sleep(0.1)
+        data = ''
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+            data += chunk
+
+        changed = set()
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # we missed some; fall back to checking everything
+                return self.registry.changed_paths(self.dirname)
+            if name:
+                changed.add(os.path.join(self.dirname, name))
+
+        return changed
+
+def watch_directory(dirname, registry):
+    """Returns a watcher for changes to the feed configs in dirname: inotify
+       where we have it, polling otherwise."""
+    try:
+        return InotifyWatcher(dirname, registry)
+    except (OSError, AttributeError):
+        return PollingWatcher(dirname, registry)
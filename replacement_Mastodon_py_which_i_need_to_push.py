@@ -11,6 +11,17 @@ import pytz
 import datetime
 import dateutil
 import dateutil.parser
+import sys
+import threading
+import hashlib
+import sqlite3
+import json
+import tempfile
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 class Mastodon:
     """
@@ -71,7 +82,7 @@ class Mastodon:
     ###
     # Authentication, including constructor
     ###
-    def __init__(self, client_id, client_secret = None, access_token = None, api_base_url = __DEFAULT_BASE_URL, debug_requests = False, ratelimit_method = "wait", ratelimit_pacefactor = 1.1, request_timeout = __DEFAULT_TIMEOUT):
+    def __init__(self, client_id, client_secret = None, access_token = None, api_base_url = __DEFAULT_BASE_URL, debug_requests = False, ratelimit_method = "wait", ratelimit_pacefactor = 1.1, request_timeout = __DEFAULT_TIMEOUT, request_hook = None, ratelimit_store = None, media_request_timeout = None):
         """
         Create a new API wrapper instance based on the given client_secret and client_id. If you
         give a client_id and it is not a file, you must also give a secret.
@@ -91,7 +102,20 @@ class Mastodon:
         If a file is given as client_id, read client ID and secret from that file.
 
         By default, a timeout of 300 seconds is used for all requests. If you wish to change this,
-        pass the desired timeout (in seconds) as request_timeout.
+        pass the desired timeout (in seconds) as request_timeout. Media uploads use
+        media_request_timeout instead, if given, as they can take much longer.
+
+        If request_hook is given, it is called after every API request with a dict
+        describing it: method, endpoint, status (None if the request failed),
+        start, duration, bytes_sent, bytes_received and ratelimit_wait (seconds
+        spent sleeping for the rate limit).
+
+        By default, rate limit state is only known to this object. If several
+        objects (in one or many processes) act for the same account, pass a
+        SQLite database file name as ratelimit_store: the state for this
+        instance and access token is then kept there, and each request takes
+        its share of the budget from it atomically before it is sent, waiting
+        (or throwing, in "throw" mode) when there is none left.
         """
         self.api_base_url = api_base_url
         self.client_id = client_id
@@ -107,6 +131,11 @@ class Mastodon:
         self.ratelimit_pacefactor = ratelimit_pacefactor
 
         self.request_timeout = request_timeout
+        self.media_request_timeout = media_request_timeout
+        self.request_hook = request_hook
+        self.ratelimit_store = ratelimit_store
+        self.__shared_ratelimit = None
+        self.__instance_limits = None
 
         if not ratelimit_method in ["throw", "wait", "pace"]:
             raise MastodonIllegalArgumentError("Invalid ratelimit method.")
@@ -123,6 +152,10 @@ class Mastodon:
             with open(self.access_token, 'r') as token_file:
                 self.access_token = token_file.readline().rstrip()
 
+        if self.ratelimit_store != None:
+            key = hashlib.sha1((self.api_base_url + ' ' + str(self.access_token)).encode('utf-8')).hexdigest()
+            self.__shared_ratelimit = _SharedRatelimit(self.ratelimit_store, key)
+
     def log_in(self, username, password, scopes = ['read', 'write', 'follow'], to_file = None):
         """
         Log in and sets access_token to what was returned. Note that your
@@ -161,6 +194,70 @@ class Mastodon:
 
         return response['access_token']
 
+    ###
+    # Reading data: Instances
+    ###
+    def instance(self):
+        """
+        Fetch information about the current instance. Needs no authentication,
+        and is cheap, so it makes a good health check.
+
+        Returns an instance dict.
+        """
+        return self.__api_request('GET', '/api/v1/instance')
+
+    def instance_limits(self, cache_file = None, ttl = 24 * 60 * 60):
+        """
+        Fetch the current instance's limits on what can be posted, so that
+        posts and uploads can be checked before they are sent. Instances that
+        don't publish a limit are assumed to have the stock Mastodon one.
+
+        The instance information is only fetched once per object. If cache_file
+        is given, it is also cached there (shared by all instances) for ttl
+        seconds.
+
+        Returns a dict with max_toot_chars, max_media_attachments,
+        image_size_limit and video_size_limit (in bytes) and
+        supported_mime_types (a list, or None if the instance doesn't say).
+        """
+        if self.__instance_limits != None:
+            return self.__instance_limits
+
+        cache = {}
+        info = None
+        if cache_file != None and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as fp:
+                    cache = json.load(fp)
+            except ValueError:
+                cache = {}
+            entry = cache.get(self.api_base_url)
+            if entry != None and entry['fetched_at'] + ttl > time.time():
+                info = entry['instance']
+
+        if info == None:
+            info = self.instance()
+            if cache_file != None:
+                cache[self.api_base_url] = {'fetched_at': time.time(), 'instance': info}
+                # write then rename, so readers never see half a file
+                fd, temp_name = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(cache_file)))
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(cache, fp)
+                os.rename(temp_name, cache_file)
+
+        configuration = info.get('configuration', {})
+        statuses = configuration.get('statuses', {})
+        media = configuration.get('media_attachments', {})
+
+        self.__instance_limits = {
+            'max_toot_chars': info.get('max_toot_chars', statuses.get('max_characters', 500)),
+            'max_media_attachments': statuses.get('max_media_attachments', 4),
+            'image_size_limit': media.get('image_size_limit', 8 * 1024 * 1024),
+            'video_size_limit': media.get('video_size_limit', 40 * 1024 * 1024),
+            'supported_mime_types': media.get('supported_mime_types'),
+        }
+        return self.__instance_limits
+
     ###
     # Reading data: Timelines
     ##
@@ -375,10 +472,170 @@ class Mastodon:
         params = self.__generate_params(locals())
         return self.__api_request('GET', '/api/v1/follow_requests', params)
 
+    ###
+    # Reading data: Scheduled statuses
+    ###
+    def scheduled_statuses(self, max_id = None, since_id = None, limit = None):
+        """
+        Fetch the authenticated user's statuses that are scheduled to be
+        posted later (see status_post).
+
+        Returns a list of scheduled toot dicts.
+        """
+        params = self.__generate_params(locals())
+        return self.__api_request('GET', '/api/v1/scheduled_statuses', params)
+
+    def scheduled_status(self, id):
+        """
+        Fetch a single scheduled status.
+
+        Returns a scheduled toot dict.
+        """
+        return self.__api_request('GET', '/api/v1/scheduled_statuses/' + str(id))
+
+    ###
+    # Reading data: Iterators
+    ###
+    def timeline_iter(self, timeline = "home", max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over a whole timeline, most recent toots first, following the
+        server's pagination links. limit is the page size. Takes the same
+        timeline names as timeline().
+
+        Pages are fetched as they are needed. With prefetch, the next page is
+        fetched in a background thread while the current one is being iterated
+        over, so at most one page more than was used is fetched if you stop
+        early. request_hook is still called on the iterating thread, but the
+        rate limit state is updated from the background one, so don't use the
+        same object elsewhere meanwhile.
+
+        Returns a generator of toot dicts.
+        """
+        params_initial = locals()
+
+        if timeline == "local":
+            timeline = "public"
+            params_initial['local'] = True
+
+        params = self.__generate_params(params_initial, ['timeline', 'prefetch'])
+        return self.__iterate_pages('/api/v1/timelines/' + timeline, params, prefetch)
+
+    def timeline_home_iter(self, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over the authenticated users home timeline. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        return self.timeline_iter('home', max_id = max_id, since_id = since_id, limit = limit, prefetch = prefetch)
+
+    def timeline_mentions_iter(self, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over the authenticated users mentions. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        return self.timeline_iter('mentions', max_id = max_id, since_id = since_id, limit = limit, prefetch = prefetch)
+
+    def timeline_local_iter(self, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over the local / instance-wide timeline. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        return self.timeline_iter('local', max_id = max_id, since_id = since_id, limit = limit, prefetch = prefetch)
+
+    def timeline_public_iter(self, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over the public / visible-network timeline. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        return self.timeline_iter('public', max_id = max_id, since_id = since_id, limit = limit, prefetch = prefetch)
+
+    def timeline_hashtag_iter(self, hashtag, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over the timeline of toots with a given hashtag. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        return self.timeline_iter('tag/' + str(hashtag), max_id = max_id, since_id = since_id, limit = limit, prefetch = prefetch)
+
+    def account_statuses_iter(self, id, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over all statuses by user id. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        params = self.__generate_params(locals(), ['id', 'prefetch'])
+        return self.__iterate_pages('/api/v1/accounts/' + str(id) + '/statuses', params, prefetch)
+
+    def account_following_iter(self, id, limit = None, prefetch = False):
+        """
+        Iterate over all users the given user is following. See timeline_iter().
+
+        Returns a generator of user dicts.
+        """
+        params = self.__generate_params(locals(), ['id', 'prefetch'])
+        return self.__iterate_pages('/api/v1/accounts/' + str(id) + '/following', params, prefetch)
+
+    def account_followers_iter(self, id, limit = None, prefetch = False):
+        """
+        Iterate over all users the given user is followed by. See timeline_iter().
+
+        Returns a generator of user dicts.
+        """
+        params = self.__generate_params(locals(), ['id', 'prefetch'])
+        return self.__iterate_pages('/api/v1/accounts/' + str(id) + '/followers', params, prefetch)
+
+    def notifications_iter(self, limit = None, prefetch = False):
+        """
+        Iterate over all notifications for the authenticated user. See timeline_iter().
+
+        Returns a generator of notification dicts.
+        """
+        params = self.__generate_params(locals(), ['prefetch'])
+        return self.__iterate_pages('/api/v1/notifications', params, prefetch)
+
+    def mutes_iter(self, limit = None, prefetch = False):
+        """
+        Iterate over all users muted by the authenticated user. See timeline_iter().
+
+        Returns a generator of user dicts.
+        """
+        params = self.__generate_params(locals(), ['prefetch'])
+        return self.__iterate_pages('/api/v1/mutes', params, prefetch)
+
+    def blocks_iter(self, limit = None, prefetch = False):
+        """
+        Iterate over all users blocked by the authenticated user. See timeline_iter().
+
+        Returns a generator of user dicts.
+        """
+        params = self.__generate_params(locals(), ['prefetch'])
+        return self.__iterate_pages('/api/v1/blocks', params, prefetch)
+
+    def favourites_iter(self, limit = None, prefetch = False):
+        """
+        Iterate over all of the authenticated user's favourited statuses. See timeline_iter().
+
+        Returns a generator of toot dicts.
+        """
+        params = self.__generate_params(locals(), ['prefetch'])
+        return self.__iterate_pages('/api/v1/favourites', params, prefetch)
+
+    def follow_requests_iter(self, max_id = None, since_id = None, limit = None, prefetch = False):
+        """
+        Iterate over all of the authenticated user's incoming follow requests. See timeline_iter().
+
+        Returns a generator of user dicts.
+        """
+        params = self.__generate_params(locals(), ['prefetch'])
+        return self.__iterate_pages('/api/v1/follow_requests', params, prefetch)
+
     ###
     # Writing data: Statuses
     ###
-    def status_post(self, status, in_reply_to_id = None, media_ids = None, sensitive = False, visibility = '', spoiler_text = None):
+    def status_post(self, status, in_reply_to_id = None, media_ids = None, sensitive = False, visibility = '', spoiler_text = None, scheduled_at = None):
         """
         Post a status. Can optionally be in reply to another status and contain
         up to four pieces of media (Uploaded via media_post()). media_ids can
@@ -402,7 +659,13 @@ class Mastodon:
         the text of the status.  If no text is passed in, no warning will be
         displayed.
 
-        Returns a toot dict with the new status.
+        If scheduled_at (a datetime, or a unix epoch) is given, the status is
+        not posted now, but scheduled to be posted by the server then. It has
+        to be at least five minutes in the future. A scheduled status can't
+        be replied to until it has been posted.
+
+        Returns a toot dict with the new status, or a scheduled toot dict if
+        the status was scheduled.
         """
         params_initial = locals()
 
@@ -429,6 +692,9 @@ class Mastodon:
 
             params_initial["media_ids"] = media_ids_proper
 
+        if scheduled_at != None:
+            params_initial["scheduled_at"] = self.__scheduled_at_to_iso8601(scheduled_at)
+
         params = self.__generate_params(params_initial)
         return self.__api_request('POST', '/api/v1/statuses', params)
 
@@ -479,6 +745,27 @@ class Mastodon:
         """
         return self.__api_request('POST', '/api/v1/statuses/' + str(id) + "/unfavourite")
 
+    ###
+    # Writing data: Scheduled statuses
+    ###
+    def scheduled_status_update(self, id, scheduled_at):
+        """
+        Move a scheduled status to a new time, which has to be at least five
+        minutes in the future.
+
+        Returns a scheduled toot dict with the updated status.
+        """
+        params = {'scheduled_at': self.__scheduled_at_to_iso8601(scheduled_at)}
+        return self.__api_request('PUT', '/api/v1/scheduled_statuses/' + str(id), params)
+
+    def scheduled_status_delete(self, id):
+        """
+        Cancel a scheduled status.
+
+        Returns an empty dict for good measure.
+        """
+        return self.__api_request('DELETE', '/api/v1/scheduled_statuses/' + str(id))
+
     ###
     # Writing data: Accounts
     ###
@@ -580,7 +867,7 @@ class Mastodon:
         file_name = "mastodonpyupload_" + str(time.time()) + "_" + str(random_suffix) + extension
 
         media_file_description = (file_name, media_file, mime_type)
-        return self.__api_request('POST', '/api/v1/media', files = {'file': media_file_description})
+        return self.__api_request('POST', '/api/v1/media', files = {'file': media_file_description}, timeout = self.media_request_timeout)
 
     ###
     # Internal helpers, dragons probably
@@ -602,12 +889,40 @@ class Mastodon:
 
         return (date_time_utc - epoch_utc).total_seconds()
 
-    def __api_request(self, method, endpoint, params = {}, files = {}, do_ratelimiting = True):
+    def __scheduled_at_to_iso8601(self, scheduled_at):
+        """
+        Converts a datetime or unix epoch to the ISO 8601 UTC timestamp the
+        API wants for scheduled statuses, checking it's far enough ahead.
+        """
+        if isinstance(scheduled_at, datetime.datetime):
+            epoch = self.__datetime_to_epoch(scheduled_at)
+        else:
+            epoch = float(scheduled_at)
+
+        if epoch < time.time() + 5 * 60:
+            raise MastodonIllegalArgumentError('Statuses can only be scheduled at least 5 minutes ahead')
+
+        return datetime.datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def __api_request(self, method, endpoint, params = {}, files = {}, do_ratelimiting = True, with_next_page = False, timeout = None):
         """
         Internal API request helper.
+
+        With with_next_page, returns a (response, next page endpoint) tuple,
+        the latter from the response's Link header (None on the last page).
+        timeout overrides request_timeout for this request.
         """
         response = None
         headers = None
+        if timeout == None:
+            timeout = self.request_timeout
+        request_started = time.time()
+        ratelimit_waited = 0.0
+
+        # Shared ratelimiting: take this request's share of the account's budget,
+        # so the numbers below are the ones every process acting for it sees.
+        if do_ratelimiting and self.__shared_ratelimit != None:
+            ratelimit_waited += self.__ratelimit_acquire()
 
         # "pace" mode ratelimiting: Assume constant rate of requests, sleep a little less long than it
         # would take to not hit the rate limit at that request rate.
@@ -618,15 +933,17 @@ class Mastodon:
                     # As a precaution, never sleep longer than 5 minutes
                     to_next = min(to_next, 5 * 60)
                     time.sleep(to_next)
+                    ratelimit_waited += to_next
             else:
                 time_waited = time.time() - self.ratelimit_lastcall
                 time_wait = float(self.ratelimit_reset - time.time()) / float(self.ratelimit_remaining)
                 remaining_wait = time_wait - time_waited
 
-            if remaining_wait > 0:
-                to_next = remaining_wait / self.ratelimit_pacefactor
-                to_next = min(to_next, 5 * 60)
-                time.sleep(to_next)
+                if remaining_wait > 0:
+                    to_next = remaining_wait / self.ratelimit_pacefactor
+                    to_next = min(to_next, 5 * 60)
+                    time.sleep(to_next)
+                    ratelimit_waited += to_next
 
         # Generate request headers
         if self.access_token != None:
@@ -646,16 +963,20 @@ class Mastodon:
             response_object = None
             try:
                 if method == 'GET':
-                    response_object = requests.get(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = self.request_timeout)
+                    response_object = requests.get(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = timeout)
 
                 if method == 'POST':
-                    response_object = requests.post(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = self.request_timeout)
+                    response_object = requests.post(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = timeout)
+
+                if method == 'PUT':
+                    response_object = requests.put(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = timeout)
 
                 if method == 'DELETE':
-                    response_object = requests.delete(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = self.request_timeout)
+                    response_object = requests.delete(self.api_base_url + endpoint, data = params, headers = headers, files = files, timeout = timeout)
             except Exception as e:
                 import traceback
                 traceback.print_exc()
+                self.__report_request(method, endpoint, None, request_started, ratelimit_waited)
                 raise MastodonNetworkError("Could not complete request: %s" % e)
 
             if response_object == None:
@@ -667,6 +988,8 @@ class Mastodon:
                 print('response headers: ' + str(response_object.headers))
                 print('Response text content: ' + str(response_object.text))
 
+            self.__report_request(method, endpoint, response_object, request_started, ratelimit_waited)
+
             if response_object.status_code == 404:
                 raise MastodonAPIError('Endpoint not found.')
 
@@ -700,20 +1023,149 @@ class Mastodon:
                     traceback.print_exc()
                     raise MastodonRatelimitError("Rate limit time calculations failed: %s" % e)
 
+                if self.__shared_ratelimit != None:
+                    self.__shared_ratelimit.update(self.ratelimit_limit, self.ratelimit_remaining, self.ratelimit_reset, self.ratelimit_lastcall)
+
                 if "error" in response and response["error"] == "Throttled":
                     if self.ratelimit_method == "throw":
                         raise MastodonRatelimitError("Hit rate limit.")
 
-                        if self.ratelimit_method == "wait" or self.ratelimit_method == "pace":
-                            to_next = self.ratelimit_reset - time.time()
-                            if to_next > 0:
-                                # As a precaution, never sleep longer than 5 minutes
-                                to_next = min(to_next, 5 * 60)
-                                time.sleep(to_next)
-                                request_complete = False
+                    if self.ratelimit_method == "wait" or self.ratelimit_method == "pace":
+                        to_next = self.ratelimit_reset - time.time()
+                        if to_next > 0:
+                            # As a precaution, never sleep longer than 5 minutes
+                            to_next = min(to_next, 5 * 60)
+                            time.sleep(to_next)
+                            ratelimit_waited += to_next
+                            request_complete = False
+
+                            # the retry is another request against the shared budget
+                            if self.__shared_ratelimit != None:
+                                ratelimit_waited += self.__ratelimit_acquire()
+
+        if with_next_page:
+            return response, self.__next_page_endpoint(response_object)
 
         return response
 
+    def __next_page_endpoint(self, response_object):
+        """
+        Internal helper: the endpoint (path and query) of the next page of a
+        paginated response, or None if there isn't one.
+        """
+        next_url = response_object.links.get('next', {}).get('url')
+        if next_url is None:
+            return None
+
+        if next_url.startswith(self.api_base_url):
+            return next_url[len(self.api_base_url):]
+
+        parsed = urlparse(next_url)
+        return parsed.path + ('?' + parsed.query if parsed.query else '')
+
+    def __iterate_pages(self, endpoint, params, prefetch = False):
+        """
+        Internal pagination helper: a generator over the items of every page
+        of a paginated endpoint, optionally fetching the next page in the
+        background while the current one is consumed.
+        """
+        # next links don't carry since_id, so we have to stop at it ourselves
+        since_id = params.get('since_id')
+        if since_id != None:
+            since_id = int(since_id)
+
+        page, next_endpoint = self.__api_request('GET', endpoint, params, with_next_page = True)
+
+        while True:
+            # API errors come back as a dict rather than a page
+            if not isinstance(page, list):
+                raise MastodonAPIError('Could not fetch a page of %s: %s' % (endpoint, page))
+
+            last_page = next_endpoint is None or len(page) == 0
+            if since_id != None and not last_page and int(page[-1]['id']) <= since_id:
+                last_page = True
+
+            fetcher = None
+            if prefetch and not last_page:
+                fetcher = _Prefetch(self.__api_request, 'GET', next_endpoint, with_next_page = True)
+
+            for item in page:
+                if since_id != None and int(item['id']) <= since_id:
+                    return
+                yield item
+
+            if last_page:
+                return
+
+            if fetcher is not None:
+                try:
+                    page, next_endpoint = fetcher.result()
+                finally:
+                    # report the background request from this thread
+                    for info in fetcher.reports:
+                        self.request_hook(info)
+            else:
+                page, next_endpoint = self.__api_request('GET', next_endpoint, with_next_page = True)
+
+    def __ratelimit_acquire(self):
+        """
+        Internal helper: reserves one request from the shared rate limit
+        budget, sleeping until the budget resets if it's used up ("throw"
+        mode raises instead). Loads the shared state into this object.
+        Returns the time spent sleeping.
+        """
+        waited = 0.0
+        while True:
+            (self.ratelimit_limit, self.ratelimit_remaining, self.ratelimit_reset,
+                self.ratelimit_lastcall) = self.__shared_ratelimit.acquire(
+                    self.ratelimit_limit, self.ratelimit_reset)
+            if self.ratelimit_remaining > 0:
+                return waited
+
+            if self.ratelimit_method == "throw":
+                raise MastodonRatelimitError("Hit rate limit.")
+
+            # As a precaution, never sleep longer than 5 minutes
+            to_next = min(max(self.ratelimit_reset - time.time(), 1), 5 * 60)
+            time.sleep(to_next)
+            waited += to_next
+
+    def __report_request(self, method, endpoint, response_object, started, ratelimit_waited):
+        """
+        Internal helper that passes a description of a finished (or failed)
+        request to request_hook, if one is set.
+        """
+        if self.request_hook is None:
+            return
+
+        # requests made for _Prefetch are reported by its caller
+        reports = getattr(threading.current_thread(), 'reports', None)
+
+        status = None
+        bytes_sent = None
+        bytes_received = None
+        if response_object is not None:
+            status = response_object.status_code
+            bytes_received = len(response_object.content)
+            body = getattr(response_object.request, 'body', None)
+            if isinstance(body, (bytes, str)):
+                bytes_sent = len(body)
+
+        info = {
+            'method': method,
+            'endpoint': endpoint,
+            'status': status,
+            'start': started,
+            'duration': time.time() - started,
+            'bytes_sent': bytes_sent,
+            'bytes_received': bytes_received,
+            'ratelimit_wait': ratelimit_waited,
+        }
+        if reports is not None:
+            reports.append(info)
+        else:
+            self.request_hook(info)
+
     def __generate_params(self, params, exclude = []):
         """
         Internal named-parameters-to-dict helper.
@@ -739,6 +1191,98 @@ class Mastodon:
 
         return params
 
+class _Prefetch(threading.Thread):
+    """
+    Runs a single call in a background thread, so its result is ready
+    (or nearly) by the time result() is called. Descriptions of the requests
+    it made are left in reports, for the caller's request_hook.
+    """
+    def __init__(self, func, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.reports = []
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()[1]
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class _SharedRatelimit(object):
+    """
+    Rate limit state for one account on one instance, kept in a SQLite
+    database so that every process acting for the account shares it.
+    """
+    # Mastodon's rate limit windows are five minutes long
+    __WINDOW = 5 * 60
+
+    def __init__(self, filename, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout = 60, isolation_level = None, check_same_thread = False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS mastodon_ratelimit ('
+                        'key TEXT PRIMARY KEY, ratelimit_limit INTEGER, remaining INTEGER, '
+                        'reset REAL, lastcall REAL)')
+
+    def acquire(self, default_limit, default_reset):
+        """
+        Atomically takes one request from the budget, if there is any left.
+        Returns (limit, remaining, reset, lastcall), with remaining as it was
+        before this request was taken.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT ratelimit_limit, remaining, reset, lastcall FROM mastodon_ratelimit WHERE key = ?', (self.key,)).fetchone()
+                if row == None:
+                    row = (default_limit, default_limit, default_reset, now)
+
+                limit, remaining, reset, lastcall = row
+                if reset <= now:
+                    # a new window; the server will correct us if we're wrong
+                    remaining = limit
+                    reset = now + self.__WINDOW
+
+                if remaining > 0:
+                    self.db.execute('INSERT OR REPLACE INTO mastodon_ratelimit VALUES (?, ?, ?, ?, ?)', (self.key, limit, remaining - 1, reset, now))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+        return (limit, remaining, reset, lastcall)
+
+    def update(self, limit, remaining, reset, lastcall):
+        """
+        Records the rate limit state reported by the server. Within the same
+        window, requests other processes have reserved but the server hasn't
+        seen yet are kept deducted.
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT remaining, reset FROM mastodon_ratelimit WHERE key = ?', (self.key,)).fetchone()
+                if row != None and abs(row[1] - reset) < 1:
+                    remaining = min(remaining, row[0])
+                self.db.execute('INSERT OR REPLACE INTO mastodon_ratelimit VALUES (?, ?, ?, ?, ?)', (self.key, limit, remaining, reset, lastcall))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
 ##
 # Exceptions
 ##
@@ -0,0 +1,67 @@
+"""Output shaping: spacing posts out over time, and deciding which of them
+are public.
+
+Posting rates are enforced with the generic cell rate algorithm: each rate
+keeps a "next_at" time, the earliest a post is due if posts were perfectly
+evenly spaced.  A post may go out once next_at (less the burst allowance)
+has passed, and pushes next_at one interval further on."""
+import time
+
+def interval_for(posts_per_hour):
+    """Seconds between posts for the given hourly rate."""
+    return 3600.0 / posts_per_hour
+
+def next_slot(next_at, interval, burst=1, now=None):
+    """The earliest time a post may go out."""
+    if now is None:
+        now = time.time()
+
+    return max(now, next_at - (burst - 1) * interval)
+
+def advance(next_at, slot, interval):
+    """The new next_at after a post goes out at slot."""
+    return max(next_at, slot) + interval
+
+class RollingBudget(object):
+    """Allows at most budget events in any window seconds."""
+    __slots__ = ('budget', 'window', 'events')
+
+    def __init__(self, budget, window, events=()):
+        self.budget = budget
+        self.window = window
+        self.events = sorted(events)
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        while self.events and self.events[0] <= cutoff:
+            self.events.pop(0)
+
+    def available(self, now=None):
+        """Is there budget left at time now (by default, right now)?  Events
+           after it count too, since they may have been booked ahead."""
+        if now is None:
+            now = time.time()
+
+        self._expire(min(now, time.time()))
+        nearby = [e for e in self.events if abs(e - now) < self.window]
+        return len(nearby) < self.budget
+
+    def spend(self, now=None):
+        """Take one from the budget at time now, if there is any left.
+           Returns whether there was."""
+        if now is None:
+            now = time.time()
+
+        if not self.available(now):
+            return False
+
+        self.events.append(now)
+        self.events.sort()
+        return True
+
+    def serialize(self):
+        return ' '.join('%d' % e for e in self.events)
+
+    @classmethod
+    def deserialize(cls, budget, window, value):
+        return cls(budget, window, [float(e) for e in value.split()])
@@ -0,0 +1,300 @@
+"""Where posts come from.
+
+A Source's fetch() returns the posts newer than a given id, newest first,
+as tweets.Tweet records, which is all the posting loop needs to know about
+them.  TwitterSource reads a Twitter timeline through the API; RssSource
+reads an RSS or Atom feed (such as a Nitter mirror of a Twitter account)
+using conditional requests, so an unchanged feed costs one empty 304."""
+import calendar
+import heapq
+import re
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import dateutil.parser
+import requests
+
+import tweets
+
+STATUS_ID = re.compile(r'/status(?:es)?/(\d+)')
+IMG_SRC = re.compile(r'<img[^>]+src="([^"]+)"', re.I)
+TAG = re.compile(r'<[^>]+>')
+
+class FeedError(IOError):
+    def __init__(self, message, status=None):
+        IOError.__init__(self, message)
+        self.status = status
+
+class Source(object):
+    """Base class for post sources."""
+    # the circuit breaker this source's failures count against
+    name = None
+    # where the posts come from, for each toot's footer
+    origin = None
+
+    def fetch(self, since=None, count=20, span=None):
+        """Returns posts newer than since, newest first.  If span is given,
+           details of the fetch are recorded on it."""
+        raise NotImplementedError
+
+class TwitterSource(Source):
+    """A Twitter API timeline, such as statuses/user_timeline.json."""
+    name = 'twitter'
+    origin = 'Twitter'
+
+    def __init__(self, auth, path, params, screen_name=None):
+        self.auth = auth
+        self.path = path
+        self.params = params
+        self.screen_name = screen_name
+
+    def fetch(self, since=None, count=20, span=None):
+        params = dict(self.params, count=count)
+        if since is not None:
+            params['since_id'] = since
+
+        return list(tweets.fetch_statuses(self.auth, self.path, params,
+            screen_name=self.screen_name, span=span))
+
+class TwitterListMembersSource(Source):
+    """A Twitter list, read by fetching each member's own timeline, workers
+       at a time, and merging them by id.  Unlike lists/statuses.json, this
+       doesn't lose tweets when a busy list posts more than one page between
+       fetches, at the cost of a request per member.  params are passed to
+       every statuses/user_timeline.json request.
+
+       lagging maps the user ids of members we couldn't fetch last time to
+       the since id to fetch them from.  After a fetch it holds the members
+       that failed this time, for the caller to keep for next time."""
+    name = 'twitter'
+    origin = 'Twitter'
+
+    # members whose timelines we can't see (protected, suspended, gone)
+    SKIP_STATUSES = (401, 403, 404)
+
+    def __init__(self, auth, owner_screen_name, slug, params, workers=8, lagging=None):
+        self.auth = auth
+        self.owner_screen_name = owner_screen_name
+        self.slug = slug
+        self.params = params
+        self.workers = workers
+        self.lagging = dict(lagging or {})
+
+    def members(self):
+        """Returns (user id, screen name) for each member of the list."""
+        members = []
+        cursor = -1
+        while cursor != 0:
+            r = tweets.request(self.auth, 'GET', 'lists/members.json',
+                {'owner_screen_name': self.owner_screen_name, 'slug': self.slug,
+                 'count': 5000, 'cursor': cursor,
+                 'skip_status': 'true', 'include_entities': 'false'}, stream=False)
+            page = r.json()
+            members.extend((u['id'], u['screen_name']) for u in page['users'])
+            cursor = page.get('next_cursor', 0)
+        return members
+
+    def _fetch_member(self, args):
+        """Returns the member's timeline back to since, count tweets a
+           page (just the one page without a since), or the TwitterError it
+           failed with."""
+        (user_id, screen_name), since, count = args
+        params = dict(self.params, user_id=user_id, count=count, trim_user='true')
+        if since is not None:
+            params['since_id'] = since
+
+        timeline = []
+        try:
+            while True:
+                page = list(tweets.fetch_statuses(self.auth, 'statuses/user_timeline.json',
+                    params, screen_name=screen_name))
+                timeline.extend(page)
+                if since is None or len(page) == 0:
+                    return timeline
+                # the rest are older than this page, and the API has stopped
+                # short of since once it returns nothing
+                params['max_id'] = page[-1].id - 1
+        except tweets.TwitterError as e:
+            if e.status in self.SKIP_STATUSES:
+                return []
+            return e
+
+    def fetch(self, since=None, count=200, span=None):
+        """As Source.fetch, with count tweets per request.  Tweet ids
+           are ordered in time across all users, so the feed's since is
+           every member's since too, except for lagging ones.  A member we
+           can't fetch is left out, and becomes lagging; only if every
+           member fails does the fetch fail."""
+        members = self.members()
+
+        def member_since(user_id):
+            lagging = self.lagging.get(user_id)
+            if lagging is None or (since is not None and since < lagging):
+                return since
+            return lagging
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = pool.map(self._fetch_member,
+                [(member, member_since(member[0]), count) for member in members])
+        finally:
+            pool.close()
+            pool.join()
+
+        timelines = []
+        lagging = {}
+        errors = []
+        for (user_id, screen_name), result in zip(members, results):
+            if isinstance(result, tweets.TwitterError):
+                lagging[user_id] = member_since(user_id)
+                errors.append(result)
+            else:
+                timelines.append(result)
+
+        if errors and len(errors) == len(members):
+            raise errors[0]
+        self.lagging = lagging
+
+        if span is not None:
+            span.set(members=len(members), failed=len(errors))
+
+        # each timeline is newest first; merge them without a full sort
+        merged = heapq.merge(*[[(-t.id, t) for t in timeline] for timeline in timelines])
+        return [t for key, t in merged]
+
+class RssSource(Source):
+    """An RSS or Atom feed.  etag and last_modified are the validators from
+       the last fetch; after a fetch they hold the new ones, for the caller
+       to keep for next time.  All new posts are returned, whatever count
+       is, since the feed may not offer them again."""
+
+    def __init__(self, url, etag=None, last_modified=None, origin='RSS'):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.origin = origin
+        self.name = 'rss:' + urlparse(url).netloc
+
+    def fetch(self, since=None, count=20, span=None):
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+
+        try:
+            r = requests.get(self.url, headers=headers, stream=True, timeout=60)
+        except requests.RequestException as e:
+            raise FeedError('Could not fetch %s: %s' % (self.url, e))
+
+        try:
+            if span is not None:
+                span.set(status=r.status_code)
+            if r.status_code == 304:
+                return []
+            if r.status_code != 200:
+                raise FeedError('HTTP %d fetching %s' % (r.status_code, self.url),
+                                status=r.status_code)
+
+            r.raw.decode_content = True
+            try:
+                posts = [p for p in parse_feed(r.raw) if since is None or p.id > since]
+            except ElementTree.ParseError as e:
+                raise FeedError('Could not parse %s: %s' % (self.url, e))
+
+            self.etag = r.headers.get('ETag')
+            self.last_modified = r.headers.get('Last-Modified')
+        finally:
+            if span is not None:
+                span.set(bytes_received=getattr(r.raw, 'tell', lambda: None)())
+            r.close()
+
+        posts.sort(key=lambda p: p.id, reverse=True)
+        return posts
+
+def _local(tag):
+    """An element's tag without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+def parse_feed(fp):
+    """Yields a Tweet for each item of an RSS or Atom feed, parsing the
+       feed as it is read and discarding each item once it's done."""
+    for event, elem in ElementTree.iterparse(fp, events=('end',)):
+        if _local(elem.tag) in ('item', 'entry'):
+            post = parse_entry(elem)
+            elem.clear()
+            if post is not None:
+                yield post
+
+def parse_entry(elem):
+    """Makes a Tweet out of an RSS item or Atom entry element.  Its id is
+       the status id in the link, if it's a Twitter (or Nitter) status, or
+       else the publication time.  Returns None if it has neither (or the
+       time can't be parsed)."""
+    fields = {}
+    links = []
+    media = []
+    author = None
+
+    for child in elem:
+        name = _local(child.tag)
+        if name == 'link':
+            href = child.get('href')
+            if href is None:
+                links.append((child.text or '').strip())
+            elif child.get('rel') == 'enclosure':
+                if child.get('type', '').startswith(('image/', 'video/')):
+                    media.append(href)
+            elif child.get('rel', 'alternate') == 'alternate':
+                links.append(href)
+        elif name in ('enclosure', 'content') and child.get('url') is not None:
+            if child.get('type', '').startswith(('image/', 'video/')):
+                media.append(child.get('url'))
+        elif name == 'author' and len(child):
+            for sub in child:
+                if _local(sub.tag) == 'name':
+                    author = sub.text
+        elif name not in fields:
+            fields[name] = (child.text or '').strip()
+
+    link = links[0] if links else fields.get('guid') or fields.get('id')
+    html = fields.get('description') or fields.get('content') or fields.get('summary') or ''
+    media.extend(unescape(src) for src in IMG_SRC.findall(html))
+    text = fields.get('title') or unescape(TAG.sub('', html)).strip()
+    author = fields.get('creator') or fields.get('author') or author
+    published = fields.get('pubDate') or fields.get('published') or fields.get('updated')
+
+    match = STATUS_ID.search(link or '')
+    if match is not None:
+        post_id = int(match.group(1))
+    elif published:
+        try:
+            when = dateutil.parser.parse(published)
+            post_id = calendar.timegm(when.utctimetuple())
+        except (ValueError, OverflowError):
+            # one garbled date shouldn't cost us the rest of the feed
+            return None
+    else:
+        return None
+
+    seen = set()
+    unique_media = []
+    for url in media:
+        if url not in seen:
+            seen.add(url)
+            unique_media.append(url)
+
+    return tweets.Tweet(id=post_id, text=text, created_at=published,
+        screen_name=author.lstrip('@') if author else None,
+        media_urls=tuple(unique_media), link=link)
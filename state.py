@@ -0,0 +1,239 @@
+"""State shared between feeds, kept in a SQLite database.
+
+Per-feed state lives in each feed's config file; anything that several
+feeds (and so several processes) have to agree on lives here instead.
+Every method does its work in a single transaction, so processes can share
+one database file safely."""
+import sqlite3
+import time
+
+import scheduler
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pace (
+    key TEXT PRIMARY KEY,
+    next_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS toot_map (
+    account TEXT NOT NULL,
+    source TEXT NOT NULL,
+    tweet_id INTEGER NOT NULL,
+    status_id TEXT NOT NULL,
+    posted_at REAL NOT NULL,
+    PRIMARY KEY (account, source, tweet_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS toot_map_posted_at ON toot_map (account, source, posted_at);
+CREATE INDEX IF NOT EXISTS toot_map_status_id ON toot_map (account, status_id);
+
+CREATE TABLE IF NOT EXISTS scheduled (
+    account TEXT NOT NULL,
+    source TEXT NOT NULL,
+    tweet_id INTEGER NOT NULL,
+    scheduled_id TEXT NOT NULL,
+    scheduled_at REAL NOT NULL,
+    PRIMARY KEY (account, source, tweet_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS breaker (
+    name TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    opened_at REAL
+);
+'''
+
+class StateStore(object):
+    """A connection to the shared state database."""
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        if self._old_tables():
+            self._upgrade()
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _begin(self):
+        # take the write lock up front, so read-modify-write is atomic
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def _old_tables(self):
+        # tables from before posts were keyed by their source as well as id
+        old = []
+        for table in ('toot_map', 'scheduled'):
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(%s)' % table)]
+            if columns and 'source' not in columns:
+                old.append(table)
+        return old
+
+    def _upgrade(self):
+        """Rebuild tables keyed by id alone.  Their ids are taken to be
+           tweets' if they're too big to be RSS items' publication times;
+           the rest get no source, which keeps them out of reconciliation."""
+        self._begin()
+        try:
+            # another process may have got here first
+            old = self._old_tables()
+            for table in old:
+                self.db.execute('ALTER TABLE %s RENAME TO old_%s' % (table, table))
+            # the renamed table's indexes keep their names
+            self.db.execute('DROP INDEX IF EXISTS toot_map_posted_at')
+            self.db.execute('DROP INDEX IF EXISTS toot_map_status_id')
+            for statement in SCHEMA.split(';'):
+                self.db.execute(statement)
+            for table in old:
+                columns = [row[1] for row in self.db.execute('PRAGMA table_info(old_%s)' % table)]
+                self.db.execute('INSERT INTO %s (source, %s) '
+                                'SELECT CASE WHEN tweet_id >= 4294967296 THEN \'twitter\' ELSE \'\' END, %s '
+                                'FROM old_%s' % (table, ', '.join(columns), ', '.join(columns), table))
+                self.db.execute('DROP TABLE old_%s' % table)
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def reserve_slot(self, key, interval, burst=1, not_before=None, horizon=None, now=None):
+        """Reserve the next posting slot for key (e.g. an instance URL),
+           keeping posts at most one per interval seconds on average with
+           up to burst posts back to back.  The slot will be no earlier
+           than not_before.  Returns the slot time, or None (reserving
+           nothing) if it would be later than horizon.  now is the time
+           horizon was worked out from, if the caller has one."""
+        if now is None:
+            now = time.time()
+        if not_before is None or not_before < now:
+            not_before = now
+
+        self._begin()
+        try:
+            row = self.db.execute('SELECT next_at FROM pace WHERE key = ?', (key,)).fetchone()
+            next_at = row[0] if row is not None else now
+
+            slot = scheduler.next_slot(next_at, interval, burst, now=not_before)
+            if horizon is not None and slot > horizon:
+                self.db.execute('ROLLBACK')
+                return None
+
+            self.db.execute('INSERT OR REPLACE INTO pace (key, next_at) VALUES (?, ?)',
+                            (key, scheduler.advance(next_at, slot, interval)))
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+        return slot
+
+    def get_status_id(self, account, source, tweet_id):
+        """The id of the Mastodon status we posted on account for tweet_id
+           from source (a Source's name), or None if we haven't."""
+        row = self.db.execute('SELECT status_id FROM toot_map '
+                              'WHERE account = ? AND source = ? AND tweet_id = ?',
+                              (account, source, tweet_id)).fetchone()
+        return row[0] if row is not None else None
+
+    def record_toot(self, account, source, tweet_id, status_id):
+        """Remember that we posted tweet_id from source as status_id on
+           account."""
+        self.db.execute('INSERT OR REPLACE INTO toot_map (account, source, tweet_id, status_id, posted_at) '
+                        'VALUES (?, ?, ?, ?, ?)', (account, source, tweet_id, str(status_id), time.time()))
+
+    def tweets_for_status(self, account, status_id):
+        """Ids of the tweets posted as status_id on account: just the one,
+           unless it was a digest."""
+        rows = self.db.execute('SELECT tweet_id FROM toot_map WHERE account = ? AND status_id = ?',
+                               (account, str(status_id)))
+        return [row[0] for row in rows]
+
+    def mirrored_tweets(self, account, source, posted_since, after_tweet_id=0, limit=100):
+        """Ids of posts from source mirrored on account since posted_since,
+           in id order, starting after after_tweet_id."""
+        rows = self.db.execute('SELECT tweet_id FROM toot_map '
+                               'WHERE account = ? AND source = ? AND posted_at >= ? AND tweet_id > ? '
+                               'ORDER BY tweet_id LIMIT ?',
+                               (account, source, posted_since, after_tweet_id, limit))
+        return [row[0] for row in rows]
+
+    def forget_toot(self, account, source, tweet_id):
+        """Drop the record of the status on account for tweet_id from
+           source."""
+        self.db.execute('DELETE FROM toot_map WHERE account = ? AND source = ? AND tweet_id = ?',
+                        (account, source, tweet_id))
+
+    def record_scheduled(self, account, source, tweet_id, scheduled_id, scheduled_at):
+        """Remember that tweet_id from source is scheduled on account as
+           scheduled_id, to be posted at scheduled_at."""
+        self.db.execute('INSERT OR REPLACE INTO scheduled '
+                        '(account, source, tweet_id, scheduled_id, scheduled_at) VALUES (?, ?, ?, ?, ?)',
+                        (account, source, tweet_id, str(scheduled_id), scheduled_at))
+
+    def is_scheduled(self, account, source, tweet_id):
+        """Whether we've scheduled tweet_id from source on account."""
+        return self.db.execute('SELECT 1 FROM scheduled WHERE account = ? AND source = ? AND tweet_id = ?',
+                               (account, source, tweet_id)).fetchone() is not None
+
+    def pending_scheduled(self, account, after):
+        """Ids of the statuses we've scheduled on account for after the
+           given time, soonest first."""
+        rows = self.db.execute('SELECT DISTINCT scheduled_id FROM scheduled '
+                               'WHERE account = ? AND scheduled_at > ? ORDER BY scheduled_at',
+                               (account, after))
+        return [row[0] for row in rows]
+
+    def scheduled_per_day(self, account, after):
+        """How many statuses we've scheduled on account for after the given
+           time, by UTC day (as days since the epoch)."""
+        rows = self.db.execute('SELECT CAST(scheduled_at / 86400 AS INTEGER), COUNT(DISTINCT scheduled_id) '
+                               'FROM scheduled WHERE account = ? AND scheduled_at > ? GROUP BY 1',
+                               (account, after))
+        return dict(rows.fetchall())
+
+    def forget_scheduled(self, account, scheduled_id=None, before=None):
+        """Drop the records of scheduled_id on account, or of everything
+           scheduled on account before the given time."""
+        if scheduled_id is not None:
+            self.db.execute('DELETE FROM scheduled WHERE account = ? AND scheduled_id = ?',
+                            (account, str(scheduled_id)))
+        else:
+            self.db.execute('DELETE FROM scheduled WHERE account = ? AND scheduled_at < ?',
+                            (account, before))
+
+    def breaker_status(self, name, cooldown):
+        """The state of the circuit breaker for name (e.g. an instance):
+           'closed' (all well), 'open' (tripped less than cooldown seconds
+           ago) or 'half-open' (tripped, and due a probe)."""
+        row = self.db.execute('SELECT opened_at FROM breaker WHERE name = ?', (name,)).fetchone()
+        if row is None or row[0] is None:
+            return 'closed'
+
+        if row[0] + cooldown > time.time():
+            return 'open'
+
+        return 'half-open'
+
+    def breaker_failure(self, name, threshold):
+        """Count a failure against name, tripping the breaker (or, if it's
+           half-open, tripping it again) after threshold failures in a row.
+           Returns whether the breaker is now open."""
+        self._begin()
+        try:
+            row = self.db.execute('SELECT failures, opened_at FROM breaker WHERE name = ?', (name,)).fetchone()
+            failures, opened_at = row if row is not None else (0, None)
+            failures += 1
+            if failures >= threshold or opened_at is not None:
+                opened_at = time.time()
+            self.db.execute('INSERT OR REPLACE INTO breaker (name, failures, opened_at) VALUES (?, ?, ?)',
+                            (name, failures, opened_at))
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+        return opened_at is not None
+
+    def breaker_success(self, name):
+        """Note a success for name, closing its breaker."""
+        self.db.execute('UPDATE breaker SET failures = 0, opened_at = NULL '
+                        'WHERE name = ? AND (failures != 0 OR opened_at IS NOT NULL)', (name,))
@@ -0,0 +1,192 @@
+"""Opt-in tracing and profiling for twit2masto runs.
+
+A Tracer records a tree of timed spans for each top-level operation (the
+initial fetch, each tweet, ...) and appends every finished tree to a file
+as one JSON object per line.  When tracing is off, NULL_TRACER stands in
+for it and every call is a no-op."""
+import json
+import sys
+import time
+import uuid
+
+class Span(object):
+    """A single timed operation, with attributes and child spans."""
+    __slots__ = ('name', 'start', 'duration', 'attrs', 'children')
+
+    def __init__(self, name, attrs, start=None, duration=None):
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.duration = duration
+        self.attrs = attrs
+        self.children = []
+
+    def set(self, **attrs):
+        """Add or update attributes on this span."""
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        d = {'name': self.name,
+             'start': round(self.start, 6),
+             'duration': round(self.duration or 0.0, 6)}
+        if self.attrs:
+            d['attrs'] = self.attrs
+        if self.children:
+            d['children'] = [c.as_dict() for c in self.children]
+        return d
+
+class _SpanContext(object):
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.span = Span(name, attrs)
+
+    def __enter__(self):
+        self.tracer._push(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.span.attrs['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+        self.span.duration = time.time() - self.span.start
+        self.tracer._pop(self.span)
+        return False
+
+class Tracer(object):
+    """Records span trees and writes each finished root span as a JSON
+       line to filename."""
+    enabled = True
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.run_id = uuid.uuid4().hex[:12]
+        self._stack = []
+        self._fp = open(filename, 'a')
+
+    def span(self, name, **attrs):
+        """Context manager timing a block as a child of the current span."""
+        return _SpanContext(self, name, attrs)
+
+    def record(self, name, start, duration, **attrs):
+        """Record an already-finished span under the current span."""
+        span = Span(name, attrs, start=start, duration=duration)
+        self._attach(span)
+        return span
+
+    def mastodon_hook(self, info):
+        """request_hook for the Mastodon client: records each API request,
+           and any rate limit sleep it did, as spans."""
+        info = dict(info)
+        start = info.pop('start')
+        duration = info.pop('duration')
+        waited = info.get('ratelimit_wait') or 0.0
+        span = Span('mastodon_request', info, start=start, duration=duration)
+        if waited > 0:
+            span.children.append(Span('ratelimit_sleep', {}, start=start, duration=waited))
+        self._attach(span)
+
+    def close(self):
+        while self._stack:
+            self._pop(self._stack[-1])
+        self._fp.close()
+
+    def _push(self, span):
+        self._stack.append(span)
+
+    def _pop(self, span):
+        while self._stack:
+            if self._stack.pop() is span:
+                break
+        self._attach(span)
+
+    def _attach(self, span):
+        if self._stack:
+            self._stack[-1].children.append(span)
+        else:
+            record = span.as_dict()
+            record['run'] = self.run_id
+            self._fp.write(json.dumps(record, sort_keys=True) + '\n')
+            self._fp.flush()
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+class NullTracer(object):
+    """Stand-in used when tracing is disabled."""
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, name, **attrs):
+        return self._span
+
+    def record(self, name, start, duration, **attrs):
+        return self._span
+
+    def close(self):
+        pass
+
+    mastodon_hook = None
+
+NULL_TRACER = NullTracer()
+
+def run_profiled(func, args=(), profile_file=None, tracemalloc_file=None):
+    """Calls func(*args), optionally under cProfile and/or tracemalloc,
+       dumping the results to the given files.  Returns func's result.
+       Without tracemalloc (before Python 3.4), tracemalloc_file gets the
+       process's peak and gained resident set size instead."""
+    tracemalloc = None
+    rss_before = None
+    if tracemalloc_file is not None:
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+            rss_before = peak_rss()
+        else:
+            tracemalloc.start(25)
+
+    profiler = None
+    if profile_file is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    try:
+        if profiler is not None:
+            return profiler.runcall(func, *args)
+        return func(*args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile_file)
+
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(tracemalloc_file, 'w') as fp:
+                fp.write('# current=%d peak=%d\n' % (current, peak))
+                for stat in snapshot.statistics('lineno')[:50]:
+                    fp.write('%s\n' % stat)
+
+        elif rss_before is not None:
+            peak = peak_rss()
+            with open(tracemalloc_file, 'w') as fp:
+                fp.write('# no tracemalloc on Python %d.%d; resident set size in bytes\n'
+                         % sys.version_info[:2])
+                fp.write('# peak=%d gained=%d\n' % (peak, peak - rss_before))
+
+def peak_rss():
+    """The process's peak resident set size so far, in bytes."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
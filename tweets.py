@@ -0,0 +1,182 @@
+"""Compact tweet records, and a streaming fetcher for the Twitter REST API.
+
+Twitter's timeline endpoints return a JSON array of large, deeply nested
+status objects, of which we only ever look at a handful of fields.  Rather
+than let the twitter package build the whole list of dicts, we request the
+responses ourselves (signed with the twitter package's OAuth object) and
+decode them one status at a time into Tweet records."""
+import codecs
+import json
+
+import requests
+
+API_BASE = 'https://api.twitter.com/1.1/'
+CHUNK_SIZE = 16 * 1024
+LOOKUP_BATCH_SIZE = 100
+
+class TwitterError(IOError):
+    def __init__(self, message, status=None):
+        IOError.__init__(self, message)
+        self.status = status
+
+class Tweet(object):
+    """The parts of a tweet we use."""
+    __slots__ = ('id', 'text', 'created_at', 'screen_name', 'media_urls',
+                 'in_reply_to_status_id', 'link')
+
+    def __init__(self, id, text, created_at, screen_name, media_urls=(),
+                 in_reply_to_status_id=None, link=None):
+        self.id = id
+        self.text = text
+        self.created_at = created_at
+        self.screen_name = screen_name
+        self.media_urls = media_urls
+        self.in_reply_to_status_id = in_reply_to_status_id
+        self.link = link
+
+    @classmethod
+    def from_status(cls, status, screen_name=None):
+        """Build a Tweet from a decoded status dict.  screen_name is used
+           when the status' user object was trimmed."""
+        user = status.get('user') or {}
+        media = status.get('entities', {}).get('media', ())
+        return cls(id=status['id'],
+                   text=status.get('full_text') or status.get('text', ''),
+                   created_at=status.get('created_at'),
+                   screen_name=user.get('screen_name', screen_name),
+                   media_urls=tuple(m['media_url_https'] for m in media
+                                    if 'media_url_https' in m),
+                   in_reply_to_status_id=status.get('in_reply_to_status_id'))
+
+    @property
+    def url(self):
+        if self.link is not None:
+            return self.link
+        return "https://twitter.com/%s/status/%d" % (self.screen_name, self.id)
+
+    def __repr__(self):
+        return '<Tweet %d by %s>' % (self.id, self.screen_name)
+
+def media_refused(limits, mimetype, size=None):
+    """Why an instance with the given limits (see Mastodon.instance_limits)
+       would refuse size bytes of media of type mimetype: 'unsupported' or
+       'too large', or None if it would take it.  Without a size only the
+       type is checked; without limits, nothing is."""
+    if limits is None:
+        return None
+
+    supported = limits['supported_mime_types']
+    if supported is not None and mimetype not in supported:
+        return 'unsupported'
+
+    if mimetype.startswith('video/'):
+        size_limit = limits['video_size_limit']
+    else:
+        size_limit = limits['image_size_limit']
+    if size is not None and size > size_limit:
+        return 'too large'
+
+    return None
+
+def iter_json_array(chunks):
+    """Incrementally decodes a JSON array from an iterable of byte strings,
+       yielding each element as soon as it has been read in full."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # skip whitespace and separators
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != u'[':
+                    raise ValueError('expected a JSON array, got %r' % buf[pos:pos + 40])
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == u']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # a value running up to the end of the buffer may be cut short
+                if end < len(buf) or eof:
+                    yield item
+                    pos = end
+                    continue
+        elif eof:
+            raise ValueError('unexpected end of JSON array')
+
+        # need more input; drop what we've consumed first
+        if pos:
+            buf = buf[pos:]
+            pos = 0
+        try:
+            buf += utf8.decode(next(chunks))
+        except StopIteration:
+            buf += utf8.decode(b'', True)
+            eof = True
+
+def request(auth, method, path, params, stream=True):
+    """Makes a signed request to the Twitter API, returning the requests
+       Response.  Raises TwitterError on failure."""
+    url = API_BASE + path
+    query = auth.encode_params(url, method, params)
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+
+    try:
+        if method == 'GET':
+            r = requests.get(url + '?' + query, headers=headers, stream=stream, timeout=60)
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            r = requests.post(url, data=query, headers=headers, stream=stream, timeout=60)
+    except requests.RequestException as e:
+        raise TwitterError('Could not complete request to %s: %s' % (path, e))
+
+    if r.status_code != 200:
+        raise TwitterError('Twitter API error %d from %s: %s' % (r.status_code, path, r.text[:500]),
+                           status=r.status_code)
+
+    return r
+
+def fetch_statuses(auth, path, params, screen_name=None, span=None):
+    """Fetches a list of statuses from the given API path (e.g.
+       'statuses/user_timeline.json') and yields them as Tweet records,
+       decoding as the response arrives.  If span is given, the number of
+       bytes received is recorded on it."""
+    r = request(auth, 'GET', path, params)
+    try:
+        for status in iter_json_array(r.iter_content(CHUNK_SIZE)):
+            yield Tweet.from_status(status, screen_name)
+    finally:
+        if span is not None:
+            span.set(bytes_received=getattr(r.raw, 'tell', lambda: None)())
+        r.close()
+
+def lookup_existing(auth, ids):
+    """Of the given tweet ids (at most LOOKUP_BATCH_SIZE), returns the set
+       that still exist, in a single statuses/lookup call."""
+    if len(ids) > LOOKUP_BATCH_SIZE:
+        raise ValueError('can only look up %d tweets at a time' % LOOKUP_BATCH_SIZE)
+
+    params = {'id': ','.join('%d' % i for i in ids),
+              'trim_user': 'true',
+              'include_entities': 'false',
+              'map': 'false'}
+    r = request(auth, 'POST', 'statuses/lookup.json', params)
+    try:
+        return set(status['id'] for status in iter_json_array(r.iter_content(CHUNK_SIZE)))
+    finally:
+        r.close()
@@ -1,4 +1,6 @@
 #!/usr/bin/env python2
+import argparse
+import calendar
 import ConfigParser
 import getpass
 import os
@@ -7,10 +9,19 @@ import time
 import readline
 import requests
 import tempfile
+import traceback
+
+import archive
+import registry
+import scheduler
+import sources
+import state
+import tracing
+import tweets
 
 CONFIG_FILE=None
-MAX_COUNT=1
 DEBUG=False
+TRACER=tracing.NULL_TRACER
 
 def read_config_file(filename=None):
     """Read and parse the configuration file, returning it as a ConfigParser
@@ -34,8 +45,36 @@ def write_config_file(config):
     if CONFIG_FILE is None:
         raise RuntimeError('CONFIG_FILE is None')
 
-    with open(CONFIG_FILE, 'w') as fp:
-        config.write(fp)
+    with TRACER.span('state_write'):
+        with open(CONFIG_FILE, 'w') as fp:
+            config.write(fp)
+
+def get_option(config, section, option, default=None):
+    """Get an option from the given section, or default if it isn't set."""
+    if (not config.has_section(section)
+        or not config.has_option(section, option)):
+            return default
+
+    return config.get(section, option)
+
+def get_general_option(config, option, default=None):
+    """Get an option from the [general] section, or default if it isn't
+       set."""
+    return get_option(config, 'general', option, default)
+
+def get_state_db(config):
+    """Returns the file name of the database shared between feeds: [general]
+       state_db, or twit2masto.sqlite next to the config file."""
+    filename = get_general_option(config, 'state_db')
+    if filename is None:
+        filename = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)),
+                                'twit2masto.sqlite')
+
+    return filename
+
+def get_state_store(config):
+    """Returns the StateStore shared between feeds."""
+    return state.StateStore(get_state_db(config))
 
 def is_list(config):
     """Are we configured to gate a Twitter list?"""
@@ -46,6 +85,10 @@ def is_list(config):
     return (config.has_option('twitter', 'twitter_list_owner')
         and config.has_option('twitter', 'twitter_list_name'))
 
+def is_rss(config):
+    """Are we configured to gate an RSS or Atom feed?"""
+    return config.has_option('rss', 'url')
+
 def is_user(config):
     """Are we configured to gate a Twitter user timeline?"""
     if not config.has_section('twitter'):
@@ -63,30 +106,120 @@ def is_pics_only_feed(config):
     return (config.has_option('general', 'pics_only')
         and config.getboolean('general', 'pics_only'))
 
-def is_visible(config):
-    """Should this post be visible, based on the time since the last
-       visible post?"""
+def is_excluding_replies(config):
+    """Are we configured to leave out replies?"""
+    return (config.has_option('twitter', 'exclude_replies')
+        and config.getboolean('twitter', 'exclude_replies'))
+
+def is_including_retweets(config):
+    """Are we configured to include retweets?  (Default: yes.)"""
+    return (not config.has_option('twitter', 'include_rts')
+        or config.getboolean('twitter', 'include_rts'))
+
+def is_scheduling(config):
+    """Are we configured to have the server post later toots for us?"""
+    return (config.has_option('general', 'schedule_mode')
+        and config.getboolean('general', 'schedule_mode'))
+
+def get_public_budget(config):
+    """Returns the rolling budget for public posts: visible_budget public
+       posts (default 1) in any visible_every seconds (default 25 hours).
+       Everything else is posted unlisted."""
     if not config.has_section('history'):
         config.add_section('history')
         write_config_file(config)
 
-    if not config.has_option('history', 'last_visible_post'):
-        config.set('history', 'last_visible_post', 1)
-        write_config_file(config)
-
     if not config.has_option('history', 'visible_every'):
         config.set('history', 'visible_every', 25*60*60)
         write_config_file(config)
 
-    last_post = config.getint('history', 'last_visible_post')
-    visible_every = config.getint('history', 'visible_every')
+    budget = int(get_option(config, 'history', 'visible_budget', 1))
+    window = config.getint('history', 'visible_every')
+
+    if config.has_option('history', 'public_posts'):
+        return scheduler.RollingBudget.deserialize(budget, window,
+            config.get('history', 'public_posts'))
+
+    # carry over the single timestamp we used to keep
+    events = []
+    if config.has_option('history', 'last_visible_post'):
+        events.append(config.getint('history', 'last_visible_post'))
 
-    if last_post + visible_every < time.time():
-        config.set('history', 'last_visible_post', int(time.time()))
+    return scheduler.RollingBudget(budget, window, events)
+
+def get_visibility(config, budget, when=None):
+    """Decide the visibility for a post going out at when (by default,
+       now), spending from the public budget if it's to be public."""
+    if budget.spend(when):
+        config.set('history', 'public_posts', budget.serialize())
         write_config_file(config)
-        return True
+        return 'public'
 
-    return False
+    return 'unlisted'
+
+def reserve_post_slot(config, store, horizon=None):
+    """Reserve the next time this feed may post, keeping to both the feed's
+       posts_per_hour and the instance's instance_posts_per_hour.  Returns
+       the time, or None if that's later than horizon (by default, max_wait
+       seconds from now), in which case we leave the rest of the backlog
+       for the next run."""
+    now = time.time()
+    if horizon is None:
+        horizon = now + float(get_general_option(config, 'max_wait', 0))
+
+    interval = scheduler.interval_for(float(get_general_option(config, 'posts_per_hour', 6)))
+    burst = int(get_general_option(config, 'burst', 1))
+    next_at = float(get_option(config, 'history', 'next_post_at', 0))
+
+    slot = scheduler.next_slot(next_at, interval, burst, now=now)
+    if slot > horizon:
+        return None
+
+    slot = store.reserve_slot(config.get('mastodon', 'MASTODON_INSTANCE'),
+        scheduler.interval_for(float(get_option(config, 'mastodon', 'instance_posts_per_hour', 30))),
+        not_before=slot, horizon=horizon, now=now)
+    if slot is None:
+        return None
+
+    if not config.has_section('history'):
+        config.add_section('history')
+    config.set('history', 'next_post_at', '%.3f' % scheduler.advance(next_at, slot, interval))
+    write_config_file(config)
+
+    return slot
+
+def get_schedule_horizon(config, store, account):
+    """How far ahead we may schedule toots: schedule_horizon seconds
+       (default a day), but not into a UTC day that already has [mastodon]
+       scheduled_per_day statuses waiting (default 25, Mastodon's limit).
+       Returns None if we mustn't schedule anything, because scheduled_total
+       (default 300) are waiting, today is full, or the instance has lately
+       refused one."""
+    now = time.time()
+    if float(get_option(config, 'history', 'schedule_refused_at', 0)) + 24*60*60 > now:
+        return None
+
+    per_day = store.scheduled_per_day(account, now)
+    if sum(per_day.values()) >= int(get_option(config, 'mastodon', 'scheduled_total', 300)):
+        return None
+
+    horizon = now + float(get_general_option(config, 'schedule_horizon', 24*60*60))
+    limit = int(get_option(config, 'mastodon', 'scheduled_per_day', 25))
+    for day in sorted(per_day):
+        if per_day[day] >= limit:
+            if day * 24*60*60 <= now:
+                return None
+            horizon = min(horizon, day * 24*60*60)
+            break
+
+    return horizon
+
+def wait_until(when):
+    """Sleep until the given time."""
+    delay = when - time.time()
+    if delay > 0:
+        with TRACER.span('schedule_wait', seconds=delay):
+            time.sleep(delay)
 
 def get_twitter(config):
     """Returns a Twitter connection object."""
@@ -163,35 +296,122 @@ def get_mastodon(config):
             client_id=config.get('mastodon', 'MASTODON_CLIENT_ID'),
             client_secret=config.get('mastodon', 'MASTODON_CLIENT_SECRET'),
             api_base_url=config.get('mastodon', 'MASTODON_INSTANCE'),
-            access_token=config.get('mastodon', 'MASTODON_USER_SECRET'))
+            access_token=config.get('mastodon', 'MASTODON_USER_SECRET'),
+            request_timeout=int(get_option(config, 'mastodon', 'request_timeout', 60)),
+            media_request_timeout=int(get_option(config, 'mastodon', 'media_request_timeout', 300)),
+            request_hook=TRACER.mastodon_hook,
+            ratelimit_store=get_state_db(config))
+
+def get_mastodon_account(config, m):
+    """Returns the user@instance name of the Mastodon account we post as,
+       looking it up the first time."""
+    if not config.has_option('mastodon', 'MASTODON_ACCOUNT'):
+        acct = m.account_verify_credentials()['acct']
+        if '@' not in acct:
+            acct = '%s@%s' % (acct, m.api_base_url.split('://', 1)[-1].rstrip('/'))
+        config.set('mastodon', 'MASTODON_ACCOUNT', acct)
+        write_config_file(config)
+
+    return config.get('mastodon', 'MASTODON_ACCOUNT')
 
 def get_twitter_whoami(t):
     return t.account.settings(_method="GET")['screen_name']
 
-def get_twitter_statuses(config, t, since=None, count=20):
+def get_twitter_source(config, t):
+    """Returns a sources.TwitterSource for the configured user or list.
+
+       We ask for the smallest payload the endpoint allows: no user objects
+       where we already know the screen name, and replies/retweets left out
+       server-side when the config says we don't want them."""
     if not config.has_section('twitter'):
         config.add_section('twitter')
         write_config_file(config)
 
+    params = {'include_rts': 'true' if is_including_retweets(config) else 'false'}
+
     if is_user(config):
-        return t.statuses.user_timeline(
-                screen_name=config.get('twitter', 'TWITTER_SCREEN_NAME'),
-                since_id=since, count=count)
+        screen_name = config.get('twitter', 'TWITTER_SCREEN_NAME')
+        params['screen_name'] = screen_name
+        params['trim_user'] = 'true'
+        params['exclude_replies'] = 'true' if is_excluding_replies(config) else 'false'
+        return sources.TwitterSource(t.auth, 'statuses/user_timeline.json',
+                params, screen_name=screen_name)
+
+    elif is_list(config) and get_option(config, 'twitter', 'list_fetch') == 'members':
+        params['exclude_replies'] = 'true' if is_excluding_replies(config) else 'false'
+        return sources.TwitterListMembersSource(t.auth,
+                config.get('twitter', 'twitter_list_owner'),
+                config.get('twitter', 'twitter_list_name'), params,
+                workers=int(get_option(config, 'twitter', 'list_workers', 8)),
+                lagging=get_list_lagging(config))
 
     elif is_list(config):
-        return t.lists.statuses(
-                owner_screen_name=config.get('twitter', 'twitter_list_owner'),
-                slug=config.get('twitter', 'twitter_list_name'),
-                since_id=since, count=count)
+        params['owner_screen_name'] = config.get('twitter', 'twitter_list_owner')
+        params['slug'] = config.get('twitter', 'twitter_list_name')
+        params['include_entities'] = 'true'
+        return sources.TwitterSource(t.auth, 'lists/statuses.json', params)
 
     else:
         raise RuntimeError('need more config: TWITTER_SCREEN_NAME or TWITTER_LIST_(OWNER,NAME)')
 
+def get_twitter_statuses(config, t, since=None, count=20, span=None):
+    """Fetch statuses newer than since for the configured user or list,
+       newest first, as a list of tweets.Tweet records."""
+    return get_twitter_source(config, t).fetch(since, count, span=span)
+
+def get_rss_source(config):
+    """Returns a sources.RssSource for the configured [rss] url, primed
+       with the validators from the last complete fetch."""
+    return sources.RssSource(config.get('rss', 'url'),
+        etag=get_option(config, 'rss', 'etag'),
+        last_modified=get_option(config, 'rss', 'last_modified'),
+        origin=get_option(config, 'rss', 'origin', 'RSS'))
+
+def set_rss_validators(config, source):
+    """Keep the feed's validators, for a conditional fetch next time."""
+    for option, value in (('etag', source.etag), ('last_modified', source.last_modified)):
+        if value is not None:
+            config.set('rss', option, value)
+        elif config.has_option('rss', option):
+            config.remove_option('rss', option)
+    write_config_file(config)
+
+def get_list_lagging(config):
+    """The list members we couldn't fetch lately, and where to fetch them
+       from: a dict of user id to since id."""
+    lagging = {}
+    for item in get_option(config, 'twitter', 'list_lagging', '').split():
+        user_id, since = item.split(':')
+        lagging[int(user_id)] = int(since)
+    return lagging
+
+def set_list_lagging(config, lagging):
+    """Keep the list members to catch up on next time."""
+    if lagging:
+        config.set('twitter', 'list_lagging', ' '.join('%d:%d' % (user_id, since or 1)
+            for user_id, since in sorted(lagging.items())))
+    elif config.has_option('twitter', 'list_lagging'):
+        config.remove_option('twitter', 'list_lagging')
+    else:
+        return
+    write_config_file(config)
+
+def get_source(config):
+    """Returns the sources.Source this feed mirrors."""
+    if is_rss(config):
+        return get_rss_source(config)
+
+    return get_twitter_source(config, get_twitter(config))
+
 def set_twitter_high_water_mark(config, last):
-    """Set the marker for the latest Twitter status processed."""
+    """Set the marker for the latest Twitter status processed.  It never
+       goes backwards, as a lagging list member's tweets may be older."""
     if not config.has_section('twitter'):
         config.add_section('twitter')
 
+    if last <= get_twitter_high_water_mark(config):
+        return
+
     config.set('twitter', 'HIGH_WATER_MARK', last)
     write_config_file(config)
 
@@ -203,69 +423,746 @@ def get_twitter_high_water_mark(config):
 
     return config.getint('twitter', 'HIGH_WATER_MARK')
 
-def rehost_image(m, url):
+def get_instance_limits(config, m):
+    """Returns what the instance will accept (see Mastodon.instance_limits),
+       cached for instance_cache_ttl seconds (default a day) in a file next
+       to the state database."""
+    return m.instance_limits(
+        cache_file=os.path.splitext(get_state_db(config))[0] + '-instances.json',
+        ttl=float(get_option(config, 'mastodon', 'instance_cache_ttl', 24*60*60)))
+
+def media_variants(url):
+    """The URLs to try for a piece of media, best first.  Twitter serves a
+       smaller rendition of images at url:small."""
+    if '//pbs.twimg.com/media/' in url:
+        return [url, url + ':small']
+
+    return [url]
+
+def download_media(url, limits=None):
+    """Downloads media from a URL, returning (data, mimetype, None), or
+       (None, None, reason) if it's missing or the instance wouldn't take
+       it.  We stop reading as soon as we know it's too big."""
+    with TRACER.span('media_download', url=url) as span:
+        r = requests.get(url, stream=True, timeout=60)
+        try:
+            span.set(status=r.status_code)
+            if r.status_code != 200:
+                return None, None, 'missing'
+
+            mimetype = r.headers.get('Content-Type', 'application/octet-stream').split(';')[0]
+            length = r.headers.get('Content-Length')
+            size = int(length) if length is not None else None
+
+            reason = tweets.media_refused(limits, mimetype, size)
+            if reason is not None:
+                span.set(skipped=reason, bytes=size)
+                return None, None, reason
+
+            data = []
+            size = 0
+            for chunk in r.iter_content(64 * 1024):
+                data.append(chunk)
+                size += len(chunk)
+                reason = tweets.media_refused(limits, mimetype, size)
+                if reason is not None:
+                    span.set(skipped=reason, bytes=size)
+                    return None, None, reason
+
+            span.set(bytes=size)
+            return b''.join(data), mimetype, None
+        finally:
+            r.close()
+
+def rehost_image(m, url, limits=None):
     """Pulls an image from a URL and rehosts it to Mastodon, returning the
-       media object."""
-    r = requests.get(url)
-    if r.status_code is 200:
-        mimetype = r.headers.get('Content-Type', 'application/octet-stream')
-        return m.media_post(r.content, mime_type=mimetype)
+       media object.  Given the instance's limits, falls back to a smaller
+       rendition if the image is too big, and uploads nothing the instance
+       would refuse."""
+    for variant in media_variants(url):
+        data, mimetype, reason = download_media(variant, limits)
+        if reason != 'too large':
+            break
 
-    return None
+    if data is None:
+        return None
 
-if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        print('need config file param')
-        sys.exit(1)
+    with TRACER.span('media_upload', mime_type=mimetype, bytes=len(data)):
+        return m.media_post(data, mime_type=mimetype)
 
-    config = read_config_file(sys.argv[1])
+def split_toot(header, text, footer, limit):
+    """Fit header + text + footer into toots of at most limit characters.
+       If it's too long, the first toot keeps the header and footer with as
+       much text as fits, and the rest of the text follows in more toots."""
+    if len(header) + len(text) + len(footer) <= limit:
+        return [header + text + footer]
 
-    twitter = get_twitter(config)
-    config = read_config_file(sys.argv[1])
-    mastodon = get_mastodon(config)
+    toots = []
+    room = limit - len(header) - len(footer) - 1
+    while text:
+        if len(text) <= room:
+            chunk, text = text, ''
+        else:
+            # break at a space if there's one reasonably near the end
+            cut = text.rfind(' ', room // 2, room)
+            if cut <= 0:
+                cut = room
+            chunk, text = text[:cut].rstrip(), text[cut:].lstrip()
+            if text:
+                chunk += u'\u2026'
+
+        if not toots:
+            toots.append(header + chunk + footer)
+            room = limit - 1
+        else:
+            toots.append(chunk)
+
+    return toots
+
+def get_breaker_settings(config):
+    """Returns the circuit breaker settings: trip after breaker_failures
+       (default 3) failed or slow requests in a row, where slow is over
+       breaker_latency seconds (default 30), and probe again after
+       breaker_cooldown seconds (default 10 minutes)."""
+    return (int(get_general_option(config, 'breaker_failures', 3)),
+            float(get_general_option(config, 'breaker_latency', 30)),
+            float(get_general_option(config, 'breaker_cooldown', 10*60)))
+
+def breaker_request_hook(store, name, failures, latency, hook=None):
+    """Returns a Mastodon request_hook counting failed, server error and
+       slow requests against the circuit breaker for name, and other
+       requests as successes.  Media uploads are slow by nature, so only
+       their failures count.  Passes everything on to hook, if given."""
+    def request_hook(info):
+        if hook is not None:
+            hook(info)
+
+        slow = (info['endpoint'] != '/api/v1/media'
+                and info['duration'] - info['ratelimit_wait'] > latency)
+        if info['status'] is None or info['status'] >= 500 or slow:
+                store.breaker_failure(name, failures)
+        else:
+            store.breaker_success(name)
+
+    return request_hook
+
+def is_healthy(store, name, cooldown, probe=None):
+    """Consult the circuit breaker for name.  While it is open, we stay
+       away.  Once it has been open for cooldown seconds, we try probe (a
+       cheap request) and close it again if that works; with no probe, the
+       caller's next request is the probe."""
+    status = store.breaker_status(name, cooldown)
+    if status == 'closed':
+        return True
+    if status == 'open':
+        return False
+
+    if probe is not None:
+        try:
+            probe()
+        except Exception as e:
+            if DEBUG: print(name, "probe failed:", e)
+            store.breaker_failure(name, 1)
+            return False
+
+        store.breaker_success(name)
+
+    return True
+
+def probe_mastodon(m):
+    """A cheap request to check a Mastodon instance is up."""
+    timeout = m.request_timeout
+    m.request_timeout = 10
+    try:
+        m.instance()
+    finally:
+        m.request_timeout = timeout
+
+def reconcile_deletions(config, t, m, store, account):
+    """Delete toots whose tweets have since been deleted.  t is the Twitter
+       connection (or anything else with its OAuth object as auth).
+
+       At most once every reconcile_every seconds (unset: never), checks
+       reconcile_batches (default 1) batches of recently mirrored tweets
+       (posted within reconcile_window seconds, default a week) against
+       Twitter, one bulk lookup per batch, working round the window from
+       where the last check left off.  To leave room for live posting,
+       this deletes at most reconcile_max_deletes toots (default 10), and
+       none while the Mastodon rate limit is less than half full.  A digest
+       toot is only deleted once all of its tweets have gone."""
+    from mastodon import MastodonAPIError
+
+    every = get_general_option(config, 'reconcile_every')
+    if every is None:
+        return
+
+    now = time.time()
+    if float(get_option(config, 'history', 'last_reconcile', 0)) + float(every) > now:
+        return
+
+    posted_since = now - float(get_general_option(config, 'reconcile_window', 7*24*60*60))
+    batches = int(get_general_option(config, 'reconcile_batches', 1))
+    max_deletes = int(get_general_option(config, 'reconcile_max_deletes', 10))
+    cursor = int(get_option(config, 'history', 'reconcile_cursor', 0))
+
+    checked = 0
+    deleted = 0
+    with TRACER.span('reconcile', cursor=cursor) as span:
+        while batches > 0:
+            ids = store.mirrored_tweets(account, 'twitter', posted_since, cursor, tweets.LOOKUP_BATCH_SIZE)
+            if len(ids) == 0:
+                if cursor == 0:
+                    break
+                # wrap around to the start of the window
+                cursor = 0
+                continue
+
+            batches -= 1
+            existing = tweets.lookup_existing(t.auth, ids)
+            checked += len(ids)
+
+            for tweet_id in ids:
+                if tweet_id not in existing:
+                    if deleted >= max_deletes or m.ratelimit_remaining < m.ratelimit_limit / 2:
+                        batches = 0
+                        break
+
+                    status_id = store.get_status_id(account, 'twitter', tweet_id)
+                    if status_id is None:
+                        # went along with another tweet of its digest
+                        cursor = tweet_id
+                        continue
+
+                    others = [i for i in store.tweets_for_status(account, status_id) if i != tweet_id]
+                    unchecked = [i for i in others if i not in ids][:tweets.LOOKUP_BATCH_SIZE]
+                    if any(i in existing for i in others) or (
+                            unchecked and tweets.lookup_existing(t.auth, unchecked)):
+                        # part of a digest whose other tweets are still there
+                        if DEBUG: print(tweet_id, "deleted on Twitter, keeping digest", status_id)
+                        store.forget_toot(account, 'twitter', tweet_id)
+                    else:
+                        if DEBUG: print(tweet_id, "deleted on Twitter, deleting", status_id)
+                        try:
+                            m.status_delete(status_id)
+                        except MastodonAPIError as e:
+                            # someone beat us to it
+                            if 'not found' not in str(e):
+                                raise
+                        for other in others:
+                            store.forget_toot(account, 'twitter', other)
+                        store.forget_toot(account, 'twitter', tweet_id)
+                        deleted += 1
+
+                cursor = tweet_id
+
+        span.set(checked=checked, deleted=deleted)
+
+    config.set('history', 'reconcile_cursor', cursor)
+    config.set('history', 'last_reconcile', int(now))
+    write_config_file(config)
+
+def watch_instance(config, m, store):
+    """Hook the Mastodon client up to its instance's circuit breaker, and
+       return the breaker's name."""
+    failures, latency, cooldown = get_breaker_settings(config)
+    instance_name = 'mastodon:' + config.get('mastodon', 'MASTODON_INSTANCE')
+    m.request_hook = breaker_request_hook(store, instance_name,
+        failures, latency, TRACER.mastodon_hook)
+
+    return instance_name
+
+def set_archive_high_water_mark(config, last):
+    """Set the marker for the latest archived tweet imported."""
+    if not config.has_section('archive'):
+        config.add_section('archive')
+
+    config.set('archive', 'HIGH_WATER_MARK', last)
+    write_config_file(config)
+
+def get_archive_high_water_mark(config):
+    """Get the marker for the latest archived tweet imported."""
+    return int(get_option(config, 'archive', 'HIGH_WATER_MARK', 0))
+
+def tweet_time(t):
+    """When t was posted, as a Unix time, or None if we can't tell."""
+    import dateutil.parser
+
+    if not t.created_at:
+        return None
+    try:
+        return calendar.timegm(dateutil.parser.parse(t.created_at).utctimetuple())
+    except (ValueError, OverflowError):
+        return None
+
+def plan_posts(config, twits):
+    """Group twits (oldest first) into posts, returning a list of lists of
+       tweets.  With [general] digest_threshold set, a burst of at least
+       that many tweets from the feed (or, for a list, from one author)
+       within digest_window seconds (default 600) of the first becomes one
+       digest post; everything else goes a tweet at a time.  Each post goes
+       in the place of its newest tweet."""
+    threshold = get_general_option(config, 'digest_threshold')
+    if threshold is None:
+        return [[t] for t in twits]
+
+    threshold = int(threshold)
+    window = float(get_general_option(config, 'digest_window', 600))
+    by_author = is_list(config)
+
+    runs = []
+    current = {}
+    for t in twits:
+        key = t.screen_name if by_author else None
+        when = tweet_time(t)
+        started, run = current.get(key, (None, None))
+        if run is None or when is None or started is None or when - started > window:
+            run = []
+            runs.append(run)
+            current[key] = (when, run)
+        run.append(t)
+
+    posts = []
+    for run in runs:
+        if len(run) >= threshold:
+            posts.append(run)
+        else:
+            posts.extend([t] for t in run)
+
+    position = dict((t.id, i) for i, t in enumerate(twits))
+    posts.sort(key=lambda post: position[post[-1].id])
+    return posts
+
+def pack_digest(header, entries, footer, limit):
+    """Fit header, entries and footer into as few toots of at most limit
+       characters as possible, breaking between entries where we can.  The
+       first toot has the header and footer.  Returns a list of (text,
+       indexes of the entries in it) pairs."""
+    toots = []
+    body, members = None, []
+
+    for i, entry in enumerate(entries):
+        wrap = 0 if toots else len(header) + len(footer)
+        if body is not None:
+            if len(body) + 2 + len(entry) + wrap <= limit:
+                body += '\n\n' + entry
+                members.append(i)
+                continue
+
+            toots.append((body if toots else header + body + footer, members))
+            body, members = None, []
+            wrap = 0
+
+        if len(entry) + wrap <= limit:
+            body, members = entry, [i]
+        elif toots:
+            toots.extend((chunk, [i]) for chunk in split_toot('', entry, '', limit))
+        else:
+            toots.extend((chunk, [i]) for chunk in split_toot(header, entry, footer, limit))
+
+    if body is not None:
+        toots.append((body if toots else header + body + footer, members))
+
+    return toots
+
+def post_tweets(config, mastodon, store, twits, rehost=rehost_image,
+                mark_done=set_twitter_high_water_mark, paced=True, origin='Twitter',
+                source='twitter'):
+    """Post twits, oldest first, to Mastodon, crediting them to origin.
+       The toots are recorded against source, the name of the Source they
+       came from, whose ids needn't be tweet ids.
+
+       rehost(mastodon, url, limits) uploads each of a tweet's media_urls,
+       and mark_done(config, id) records how far we've got.  Paced, we post
+       as fast as the scheduler lets us; unpaced, only the instance's rate
+       limit holds us back, and everything is unlisted.  Bursts may be
+       combined into digests, see plan_posts.
+
+       In schedule_mode, paced toots due later than now are handed to the
+       server as scheduled statuses, as far ahead as get_schedule_horizon
+       allows, instead of waiting for them here.
+
+       Returns whether any tweets were left for a later run."""
+    from mastodon import MastodonAPIError
+
+    failures, latency, cooldown = get_breaker_settings(config)
+    instance_name = 'mastodon:' + config.get('mastodon', 'MASTODON_INSTANCE')
+    public_budget = get_public_budget(config)
+    account = get_mastodon_account(config, mastodon)
+    limits = get_instance_limits(config, mastodon)
+    max_media = limits['max_media_attachments']
+
+    scheduling = paced and is_scheduling(config)
+    if scheduling:
+        # by a day after, they've long been posted
+        store.forget_scheduled(account, before=time.time() - 24*60*60)
+
+    # a digest goes out after tweets newer than some of its own, so the
+    # high water mark only moves up to the oldest tweet still to post, and
+    # anything already mirrored is skipped if it comes round again
+    position = dict((t.id, i) for i, t in enumerate(twits))
+    done = [store.get_status_id(account, source, t.id) is not None
+            or store.is_scheduled(account, source, t.id) for t in twits]
+    marked = [0]
+
+    def finish(post):
+        for t in post:
+            done[position[t.id]] = True
+        upto = marked[0]
+        while upto < len(done) and done[upto]:
+            upto += 1
+        if upto > marked[0]:
+            marked[0] = upto
+            mark_done(config, twits[upto - 1].id)
+
+    finish([])
+    for post in plan_posts(config, [t for t in twits if not done[position[t.id]]]):
+        t = post[-1]
+        with TRACER.span('tweet', id=t.id) as tweet_span:
+            if DEBUG: print(t.id, t.created_at, t.screen_name, "considering", len(post))
+            if len(post) > 1:
+                tweet_span.set(digest=len(post))
+
+            with TRACER.span('filter') as span:
+                if is_pics_only_feed(config):
+                    kept = [p for p in post if len(p.media_urls) > 0]
+                else:
+                    kept = post
+                span.set(skip=len(kept) == 0)
+
+            if len(kept) == 0:
+                if DEBUG: print(t.id, t.created_at, t.screen_name, "skipping due to no pics")
+                tweet_span.set(skipped='no pics')
+                finish(post)
+                continue
+
+            header = ''
+            if is_list(config) and not is_rss(config):
+                header = "From: @%s@twitter.com\n\n" % t.screen_name
+
+            if len(kept) == 1:
+                footer = "\n\n---\n * Origin: %s (%s)\n#bot" % (origin, kept[0].url)
+                my_toots = [(text, [0] if i == 0 else [])
+                            for i, text in enumerate(split_toot(header, kept[0].text,
+                                                                footer, limits['max_toot_chars']))]
+                media_urls = kept[0].media_urls[:max_media]
+            else:
+                footer = "\n\n---\n * Origin: %s (%d posts)\n#bot" % (origin, len(kept))
+                my_toots = pack_digest(header, [u'%s\n%s' % (p.text, p.url) for p in kept],
+                                       footer, limits['max_toot_chars'])
+                # pool everyone's media, filling each toot in turn
+                media_urls = [url for p in kept for url in p.media_urls][:max_media * len(my_toots)]
+
+            # don't download media for an instance that's gone away
+            if store.breaker_status(instance_name, cooldown) != 'closed':
+                if DEBUG: print(instance_name, "circuit breaker tripped, stopping")
+                tweet_span.set(deferred=True)
+                return True
+
+            scheduled_at = None
+            if paced:
+                # a thread can't be scheduled, as there's nothing to reply
+                # to until its first toot is posted
+                horizon = None
+                if scheduling and len(my_toots) == 1:
+                    horizon = get_schedule_horizon(config, store, account)
+                slot = reserve_post_slot(config, store, horizon)
+                if slot is None:
+                    if DEBUG: print(t.id, t.created_at, t.screen_name, "no slot, leaving for next run")
+                    tweet_span.set(deferred=True)
+                    return True
+
+                if horizon is not None and slot > time.time():
+                    scheduled_at = slot
+                else:
+                    wait_until(slot)
+
+            pics = []
+
+            for media_url in media_urls:
+                media_id = rehost(mastodon, media_url, limits)
+                if media_id is not None:
+                    pics.append(media_id)
+                if DEBUG: print(t.id, t.created_at, t.screen_name, "media added", media_url, media_id)
+
+            if len(pics) == 0 and is_pics_only_feed(config):
+                tweet_span.set(skipped='media failed')
+                finish(post)
+                continue
+
+            # thread replies to tweets we've already mirrored
+            in_reply_to_id = None
+            if kept[0].in_reply_to_status_id is not None:
+                in_reply_to_id = store.get_status_id(account, source, kept[0].in_reply_to_status_id)
+
+            if scheduled_at is not None:
+                # the server wants at least five minutes' notice, and media
+                # uploads may have eaten into it
+                scheduled_at = max(scheduled_at, time.time() + 6*60)
+
+            if paced:
+                visibility = get_visibility(config, public_budget, scheduled_at)
+            else:
+                visibility = 'unlisted'
+
+            # whatever didn't fit the first toot follows as unlisted replies
+            status_ids = {}
+            for i, (text, members) in enumerate(my_toots):
+                toot_pics = pics[i * max_media:(i + 1) * max_media] or None
+                with TRACER.span('status_post', visibility=visibility, chars=len(text),
+                                 in_reply_to_id=in_reply_to_id, scheduled_at=scheduled_at):
+                    toot = mastodon.status_post(text, in_reply_to_id=in_reply_to_id,
+                        media_ids=toot_pics, visibility=visibility, scheduled_at=scheduled_at)
+
+                # the client hands back API errors rather than raising them
+                if 'error' in toot:
+                    tweet_span.set(error=toot['error'])
+                    if scheduled_at is not None:
+                        # most likely the account's scheduling limits; post
+                        # live from now on
+                        if DEBUG: print(t.id, "scheduling refused:", toot['error'])
+                        config.set('history', 'schedule_refused_at', int(time.time()))
+                        write_config_file(config)
+                        return True
+                    if toot['error'] == 'Throttled':
+                        # worth another go next run; the client raises on
+                        # server errors itself
+                        raise MastodonAPIError('Could not post tweet %d: %s' % (t.id, toot['error']))
+                    if DEBUG: print(t.id, "rejected:", toot['error'])
+                    # anything else won't go through however often we try, so
+                    # keep what's posted of the thread and move on
+                    break
+
+                for member in members:
+                    status_ids.setdefault(kept[member].id, toot['id'])
+                in_reply_to_id = toot['id']
+                visibility = 'unlisted'
+
+            for tweet_id, status_id in status_ids.items():
+                if scheduled_at is not None:
+                    store.record_scheduled(account, source, tweet_id, status_id, scheduled_at)
+                else:
+                    store.record_toot(account, source, tweet_id, status_id)
+            finish(post)
+
+    return False
+
+def main(filename, mastodon=None):
+    """Mirror new statuses for the feed configured in filename, using the
+       given Mastodon client if there is one."""
+    config = read_config_file(filename)
+
+    source = get_source(config)
+    config = read_config_file(filename)
+    if mastodon is None:
+        mastodon = get_mastodon(config)
+
+    # skip feeds whose instance (or source) is down, before doing any work
+    store = get_state_store(config)
+    failures, latency, cooldown = get_breaker_settings(config)
+    instance_name = watch_instance(config, mastodon, store)
+
+    if not is_healthy(store, source.name, cooldown):
+        if DEBUG: print(source.name, "circuit breaker open, skipping")
+        store.close()
+        return
+
+    if not is_healthy(store, instance_name, cooldown, lambda: probe_mastodon(mastodon)):
+        if DEBUG: print(instance_name, "circuit breaker open, skipping")
+        store.close()
+        return
 
     # get latest twitter stuff
     #me_twitter = get_twitter_whoami(twitter)
     hwm = get_twitter_high_water_mark(config)
-    config = read_config_file(sys.argv[1])
+    config = read_config_file(filename)
+
+    lagging = None
+    if isinstance(source, sources.TwitterListMembersSource):
+        lagging = dict(source.lagging)
 
-    twits = get_twitter_statuses(config, twitter, hwm)
+    with TRACER.span('fetch', source=source.name, since_id=hwm) as span:
+        started = time.time()
+        try:
+            twits = source.fetch(hwm, span=span)
+        except (tweets.TwitterError, sources.FeedError) as e:
+            if e.status is None or e.status >= 500:
+                store.breaker_failure(source.name, failures)
+            raise
+        if time.time() - started > latency:
+            store.breaker_failure(source.name, failures)
+        else:
+            store.breaker_success(source.name)
+        span.set(count=len(twits))
     twits.reverse()
 
-    # send it to the mastodon
-    countdown = MAX_COUNT
+    if lagging is not None:
+        # members that failed go from where they were until we've caught up
+        lagging.update(source.lagging)
+        set_list_lagging(config, lagging)
 
-    for t in twits:
-        t_url = "https://twitter.com/%s/status/%d" % (t['user']['screen_name'], t['id'])
-        if DEBUG: print(t['id'], t['created_at'], t['user']['screen_name'], "considering")
-        if hwm is None or t['id'] > hwm: hwm = t['id']
+    # send it to the mastodon, as fast as the scheduler lets us
+    deferred = post_tweets(config, mastodon, store, twits, origin=source.origin, source=source.name)
 
-        pics = None
+    if not deferred:
+        # only skip unchanged feeds once we've posted everything in them
+        if isinstance(source, sources.RssSource):
+            set_rss_validators(config, source)
+        if isinstance(source, sources.TwitterListMembersSource):
+            set_list_lagging(config, source.lagging)
 
-        if 'entities' in t:
-            if 'media' in t['entities']:
-                for media in t['entities']['media']:
-                    if 'media_url_https' in media:
-                        if pics is None: pics = []
-                        media_id = rehost_image(mastodon, media['media_url_https'])
-                        pics.append(media_id)
-                        if DEBUG: print(t['id'], t['created_at'], t['user']['screen_name'], "media added", media, media_id)
+        # tidy up after deleted tweets, but only once we've caught up
+        if source.name == 'twitter':
+            reconcile_deletions(config, source, mastodon, store,
+                get_mastodon_account(config, mastodon))
 
-        if (pics is None or len(pics) == 0) and is_pics_only_feed(config):
-            if DEBUG: print(t['id'], t['created_at'], t['user']['screen_name'], "skipping due to no pics")
-            continue
+    store.close()
 
-        my_toot = "%s\n\n---\n * Origin: Twitter (%s)\n#bot" % (t['text'], t_url)
+def import_archive(filename, archive_filename):
+    """Mirror the tweets in a Twitter archive export to the Mastodon account
+       configured in filename, picking up where any earlier import left off.
+       This isn't paced by the scheduler: it goes as fast as the instance's
+       rate limit allows, posting unlisted."""
+    config = read_config_file(filename)
+    mastodon = get_mastodon(config)
 
-        if is_list(config):
-            my_toot = "From: @%s@twitter.com\n\n%s" % (t['user']['screen_name'], my_toot)
+    store = get_state_store(config)
+    failures, latency, cooldown = get_breaker_settings(config)
+    instance_name = watch_instance(config, mastodon, store)
+    if not is_healthy(store, instance_name, cooldown, lambda: probe_mastodon(mastodon)):
+        print("%s seems to be down, try again later" % instance_name)
+        store.close()
+        return
 
-        mastodon.status_post(my_toot, media_ids=pics, visibility='public' if is_visible(config) else 'unlisted')
+    hwm = get_archive_high_water_mark(config)
 
-        countdown -= 1
-        if countdown <= 0:
-            break
+    with archive.TwitterArchive(archive_filename) as twitter_archive:
+        # only the compact records are kept, so sorting them is cheap next
+        # to the size of the archive
+        with TRACER.span('fetch', archive=archive_filename, since_id=hwm) as span:
+            twits = sorted(twitter_archive.tweets(since=hwm), key=lambda t: t.id)
+            span.set(count=len(twits))
+
+        print("Importing %d tweets from %s" % (len(twits), archive_filename))
+        post_tweets(config, mastodon, store, twits,
+            rehost=twitter_archive.rehost_media,
+            mark_done=set_archive_high_water_mark, paced=False)
+
+    store.close()
+
+def cancel_scheduled(filename):
+    """Cancel the statuses we've scheduled, and that haven't been posted
+       yet, on the Mastodon account configured in filename.  Their tweets
+       won't be posted again."""
+    from mastodon import MastodonAPIError
+
+    config = read_config_file(filename)
+    mastodon = get_mastodon(config)
+    store = get_state_store(config)
+    account = get_mastodon_account(config, mastodon)
+
+    pending = store.pending_scheduled(account, time.time())
+    for scheduled_id in pending:
+        if DEBUG: print(scheduled_id, "cancelling")
+        try:
+            mastodon.scheduled_status_delete(scheduled_id)
+        except MastodonAPIError as e:
+            # posted (or cancelled) in the meantime
+            if 'not found' not in str(e):
+                raise
+        store.forget_scheduled(account, scheduled_id)
+
+    print("Cancelled %d scheduled statuses" % len(pending))
+    store.close()
+
+def run_daemon(dirname, interval=60):
+    """Look after every feed configured in dirname, running each at most
+       once per interval seconds, whenever its scheduler would let it post.
+       Feeds are added, reloaded and dropped as their config files change,
+       without a restart; each Mastodon client is kept for as long as a
+       feed uses its credentials.  Feeds that haven't been logged in yet
+       need a run by hand first, and are left alone until then."""
+    feeds = registry.FeedRegistry()
+    feeds.load_directory(dirname)
+    watcher = registry.watch_directory(dirname, feeds)
+    clients = {}
+    last_run = {}
+
+    try:
+        while True:
+            now = time.time()
+            for feed in feeds.due(now):
+                if not feed.runnable:
+                    continue
+                if last_run.get(feed.path, 0) + interval > now:
+                    continue
 
-    # don't do anything more
-    set_twitter_high_water_mark(config, hwm)
+                key = (feed.app, feed.user_secret)
+                try:
+                    if key not in clients:
+                        clients[key] = get_mastodon(read_config_file(feed.path))
+                    main(feed.path, clients[key])
+                except Exception:
+                    traceback.print_exc()
+                last_run[feed.path] = time.time()
+
+            # sleep until the next feed is due, or a config file changes
+            # (including our own writes, which keep the registry current)
+            now = time.time()
+            wake = now + interval
+            for feed in feeds:
+                if feed.runnable:
+                    wake = min(wake, max(feed.next_post_at, last_run.get(feed.path, 0) + interval))
+            added, updated, removed = feeds.apply(watcher.changes(max(wake - now, 1)))
+
+            if DEBUG and (added or removed):
+                print("feeds added: %s, removed: %s" % (added, removed))
+            for path in removed:
+                last_run.pop(path, None)
+
+            # let go of clients no feed uses any more
+            in_use = set((feed.app, feed.user_secret) for feed in feeds)
+            for key in list(clients):
+                if key not in in_use:
+                    del clients[key]
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mirror a Twitter feed to Mastodon.')
+    parser.add_argument('config', nargs='?', help='the feed\'s config file')
+    parser.add_argument('--import-archive', metavar='ZIP',
+        help='import the tweets in this Twitter archive export instead')
+    parser.add_argument('--cancel-scheduled', action='store_true',
+        help='cancel the statuses this feed has scheduled instead')
+    parser.add_argument('--daemon', metavar='DIR',
+        help='keep running every feed configured in this directory instead')
+    parser.add_argument('--interval', type=int, default=60,
+        help='with --daemon, the least time between runs of a feed (default 60s)')
+    args = parser.parse_args()
+
+    if args.daemon is not None:
+        run_daemon(args.daemon, args.interval)
+        sys.exit(0)
+    if args.config is None:
+        parser.error('a config file (or --daemon) is required')
+
+    config = read_config_file(args.config)
+
+    # opt-in tracing and profiling, see tracing.py
+    trace_file = get_general_option(config, 'trace_file')
+    if trace_file is not None:
+        TRACER = tracing.Tracer(trace_file)
+
+    if args.import_archive is not None:
+        run, run_args = import_archive, (args.config, args.import_archive)
+    elif args.cancel_scheduled:
+        run, run_args = cancel_scheduled, (args.config,)
+    else:
+        run, run_args = main, (args.config,)
 
+    try:
+        tracing.run_profiled(run, run_args,
+            profile_file=get_general_option(config, 'profile_file'),
+            tracemalloc_file=get_general_option(config, 'tracemalloc_file'))
+    finally:
+        TRACER.close()